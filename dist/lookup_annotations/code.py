@@ -1,6 +1,155 @@
+import http.cookiejar
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from functools import wraps
+from itertools import islice
+from typing import Any, Callable, Dict, Iterator
+from urllib.parse import urlsplit
+
 import requests
-from typing import Dict
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 30
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+MAX_RETRY_DELAY = 5
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+MAX_CONNECTIONS_PER_HOST = 10
+
+# Module level, so that a warm worker keeps its keep-alive connections between invocations.
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+_host_slots: dict[str, threading.BoundedSemaphore] = {}
+
+
+def _get_session() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            # Share connections only: invocations of other organizations must never be sent cookies set for this one
+            _session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            adapter = HTTPAdapter(pool_maxsize=MAX_CONNECTIONS_PER_HOST)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def _get_host_slot(url: str) -> threading.BoundedSemaphore:
+    host = urlsplit(url).netloc
+    with _session_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+        return _host_slots[host]
+
+
+def _request(
+    method: str, url: str, max_retries: int = MAX_RETRIES, idempotent: bool | None = None, **kwargs: Any
+) -> requests.Response:
+    """
+    Send a request over the pooled session, retrying with backoff.
+
+    Idempotent requests (by method, or as declared by the caller) are retried on connection errors and
+    429/5xx responses. Other requests are retried only when they cannot have been processed, i.e. on a
+    connect timeout or a 429, so that e.g. an insert is never applied twice.
+    """
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+    retry_errors = requests.exceptions.ConnectionError if idempotent else requests.exceptions.ConnectTimeout
+    retry_status_codes = RETRY_STATUS_CODES if idempotent else (429,)
+    session = _get_session()
+    host_slot = _get_host_slot(url)
+
+    attempt = 0
+    while True:
+        try:
+            with host_slot, _phase("network"):
+                response = session.request(method, url, **kwargs)
+        except retry_errors:
+            if attempt >= max_retries:
+                raise
+            delay = RETRY_BACKOFF * 2**attempt
+        else:
+            if response.status_code not in retry_status_codes or attempt >= max_retries:
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            delay = float(retry_after) if retry_after.isdigit() else RETRY_BACKOFF * 2**attempt
+            response.close()
+
+        # Back off outside of the host slot, so that other callers to the host are not held up
+        time.sleep(min(delay, MAX_RETRY_DELAY))
+        attempt += 1
+
+
+# Per-phase timings of the current invocation in milliseconds, None unless the "timings" setting is on
+_timings: ContextVar[dict[str, float] | None] = ContextVar("timings", default=None)
+# Phases may be timed from worker threads of the same invocation, e.g. concurrent queries
+_timings_lock = threading.Lock()
+
+
+@contextmanager
+def _phase(name: str) -> Iterator[None]:
+    """Add the time spent in the block to the timings of the current invocation, if they are recorded."""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        with _timings_lock:
+            timings[name] = timings.get(name, 0.0) + elapsed
 
+
+def _instrumented(handler: Callable[[dict], Any]) -> Callable[[dict], Any]:
+    """
+    Record per-phase timings of an invocation when the "timings" setting is "response" or "log".
+
+    Phases are cumulative and may nest or overlap, e.g. concurrent network calls or a network call
+    made while computing an embedding. "total" is the wall time of the whole invocation.
+    """
+
+    @wraps(handler)
+    def wrapper(payload: dict) -> Any:
+        mode = (payload.get("settings") or {}).get("timings")
+        if mode not in ("response", "log"):
+            return handler(payload)
+
+        timings: dict[str, float] = {}
+        reset_token = _timings.set(timings)
+        try:
+            with _phase("total"):
+                result = handler(payload)
+        finally:
+            _timings.reset(reset_token)
+
+        timings = {name: round(milliseconds, 3) for name, milliseconds in timings.items()}
+        if mode == "response" and isinstance(result, dict):
+            result["timings"] = timings
+        else:
+            log.info("Hook timings", extra={"timings": timings})
+        return result
+
+    return wrapper
+
+
+def _decode(response: requests.Response) -> Any:
+    with _phase("decode"):
+        return response.json()
+
+
+@_instrumented
 def rossum_hook_request_handler(payload:dict):
     configure = payload["configure"]
     rossum_authorization_token = payload["rossum_authorization_token"]
@@ -16,11 +165,17 @@ def rossum_hook_request_handler(payload:dict):
             }
         }
     
-    def find_data() -> Dict:
+    page_size = int(payload["payload"].get("page_size", 100))
+    max_options = payload["payload"].get("max_options")
+    prefetch = payload["payload"].get("prefetch", False)
+
+    def find_data(url: str) -> Dict:
         """Find data from the API"""
                         
-        response = requests.post(
-            f"{base_url}/api/v1/annotations/search?page_size=100&sideload=documents",
+        response = _request(
+            "POST",
+            url,
+            idempotent=True,
             headers={
                 "Content-Type": "application/json",
                 "Authorization": f"Bearer {rossum_authorization_token}",
@@ -51,20 +206,41 @@ def rossum_hook_request_handler(payload:dict):
                 }
             }
         )
-        return response.json()
-        
-    data = find_data()
+        return _decode(response)
+
+    def iterate_annotations() -> Iterator[Dict]:
+        """Yield annotations from all pages of the search, each joined with its sideloaded document"""
+
+        # Searching the next page is a POST of the same query to the "next" URL
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            page = find_data(f"{base_url}/api/v1/annotations/search?page_size={page_size}&sideload=documents")
+            while page:
+                next_url = (page.get("pagination") or {}).get("next")
+                next_page = executor.submit(copy_context().run, find_data, next_url) if executor and next_url else None
+
+                documents = {doc["url"]: doc for doc in page.get("documents", [])}
+                for result in page["results"]:
+                    result["document_ref"] = documents.get(result["document"], {})
+                    yield result
+
+                page = next_page.result() if next_page else find_data(next_url) if next_url else None
+        finally:
+            if executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+
     options = []
 
-    for result in data["results"]:
-        result["document_ref"] = [doc for doc in data["documents"] if doc['url'] == result["document"]][0]
-        result["document__original_file_name"] = result["document_ref"]["original_file_name"]
-        options.append({
-            "value": str(result[payload["payload"]["value_key"]]),
-            "label": str(result[payload["payload"]["label_key"]]),
-        })
+    # Stop paginating as soon as enough options were collected
+    for result in islice(iterate_annotations(), int(max_options) if max_options else None):
+        with _phase("shaping"):
+            result["document__original_file_name"] = result["document_ref"].get("original_file_name")
+            options.append({
+                "value": str(result[payload["payload"]["value_key"]]),
+                "label": str(result[payload["payload"]["label_key"]]),
+            })
     
     return {
         "options": options,
-        "value": str(data["results"][0][payload["payload"]["value_key"]]) if data["results"] else None,
+        "value": options[0]["value"] if options else None,
     }
\ No newline at end of file
@@ -1,9 +1,35 @@
 # flake8: noqa
+import hashlib
+import http.cookiejar
 import json
+import logging
 import re
-from typing import Any
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from functools import partial, wraps
+from typing import Any, Callable, Hashable, Iterator
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 30
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+MAX_RETRY_DELAY = 5
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+MAX_CONNECTIONS_PER_HOST = 10
+QUERY_TEMPLATE_CACHE_SIZE = 128
+CREDENTIALS_TTL = 300
+DATASET_METADATA_TTL = 60
+TTL_CACHE_SIZE = 256
 
 
 def get_computed_field_suggestion_prompt(
@@ -493,8 +519,206 @@ MongoDB aggregation query:
     return prompt
 
 
+# Module level, so that a warm worker keeps its keep-alive connections between invocations.
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+_host_slots: dict[str, threading.BoundedSemaphore] = {}
+
+
+def _get_session() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            # Share connections only: invocations of other organizations must never be sent cookies set for this one
+            _session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            adapter = HTTPAdapter(pool_maxsize=MAX_CONNECTIONS_PER_HOST)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def _get_host_slot(url: str) -> threading.BoundedSemaphore:
+    host = urlsplit(url).netloc
+    with _session_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+        return _host_slots[host]
+
+
+def _request(
+    method: str, url: str, max_retries: int = MAX_RETRIES, idempotent: bool | None = None, **kwargs: Any
+) -> requests.Response:
+    """
+    Send a request over the pooled session, retrying with backoff.
+
+    Idempotent requests (by method, or as declared by the caller) are retried on connection errors and
+    429/5xx responses. Other requests are retried only when they cannot have been processed, i.e. on a
+    connect timeout or a 429, so that e.g. an insert is never applied twice.
+    """
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+    retry_errors = requests.exceptions.ConnectionError if idempotent else requests.exceptions.ConnectTimeout
+    retry_status_codes = RETRY_STATUS_CODES if idempotent else (429,)
+    session = _get_session()
+    host_slot = _get_host_slot(url)
+
+    attempt = 0
+    while True:
+        try:
+            with host_slot, _phase("network"):
+                response = session.request(method, url, **kwargs)
+        except retry_errors:
+            if attempt >= max_retries:
+                raise
+            delay = RETRY_BACKOFF * 2**attempt
+        else:
+            if response.status_code not in retry_status_codes or attempt >= max_retries:
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            delay = float(retry_after) if retry_after.isdigit() else RETRY_BACKOFF * 2**attempt
+            response.close()
+
+        # Back off outside of the host slot, so that other callers to the host are not held up
+        time.sleep(min(delay, MAX_RETRY_DELAY))
+        attempt += 1
+
+
+# Per-phase timings of the current invocation in milliseconds, None unless the "timings" setting is on
+_timings: ContextVar[dict[str, float] | None] = ContextVar("timings", default=None)
+# Phases may be timed from worker threads of the same invocation, e.g. concurrent queries
+_timings_lock = threading.Lock()
+
+
+@contextmanager
+def _phase(name: str) -> Iterator[None]:
+    """Add the time spent in the block to the timings of the current invocation, if they are recorded."""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        with _timings_lock:
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def _instrumented(handler: Callable[[dict], Any]) -> Callable[[dict], Any]:
+    """
+    Record per-phase timings of an invocation when the "timings" setting is "response" or "log".
+
+    Phases are cumulative and may nest or overlap, e.g. concurrent network calls or a network call
+    made while computing an embedding. "total" is the wall time of the whole invocation.
+    """
+
+    @wraps(handler)
+    def wrapper(payload: dict) -> Any:
+        mode = (payload.get("settings") or {}).get("timings")
+        if mode not in ("response", "log"):
+            return handler(payload)
+
+        timings: dict[str, float] = {}
+        reset_token = _timings.set(timings)
+        try:
+            with _phase("total"):
+                result = handler(payload)
+        finally:
+            _timings.reset(reset_token)
+
+        timings = {name: round(milliseconds, 3) for name, milliseconds in timings.items()}
+        if mode == "response" and isinstance(result, dict):
+            result["timings"] = timings
+        else:
+            log.info("Hook timings", extra={"timings": timings})
+        return result
+
+    return wrapper
+
+
+def _decode(response: requests.Response) -> Any:
+    with _phase("decode"):
+        return response.json()
+
+
+class TTLCache:
+    """
+    Thread-safe cache whose entries expire ttl seconds after they were loaded.
+
+    Concurrent misses of the same key wait for a single load instead of each calling the loader.
+    Failed loads are not cached. Expired entries are purged on insert and at most max_entries are kept,
+    dropping the oldest loads first.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = TTL_CACHE_SIZE) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: dict[Hashable, tuple[float, Any]] = {}
+        self._loading: dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+
+            future = self._loading.get(key)
+            is_loader = future is None
+            if is_loader:
+                future = self._loading[key] = Future()
+
+        if not is_loader:
+            return future.result()
+
+        try:
+            value = loader()
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            now = time.monotonic()
+            expired = [cached_key for cached_key, (expires_at, _) in self._entries.items() if expires_at <= now]
+            for cached_key in expired:
+                del self._entries[cached_key]
+            # Re-insert, so that the entries stay ordered by load time
+            self._entries.pop(key, None)
+            self._entries[key] = (now + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+            del self._loading[key]
+        future.set_result(value)
+        return value
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate: Callable[[Any], bool]) -> None:
+        with self._lock:
+            for key in [key for key, (_, value) in self._entries.items() if predicate(value)]:
+                del self._entries[key]
+
+
+def token_fingerprint(token: str | None) -> str:
+    return hashlib.sha256((token or "").encode("utf-8")).hexdigest()[:16]
+
+
+# Shared by all invocations of a warm worker, keyed by base URL and a fingerprint of the token
+_credentials_cache = TTLCache(CREDENTIALS_TTL)
+_dataset_metadata_cache = TTLCache(DATASET_METADATA_TTL)
+
+
 def get_organization(payload: dict) -> dict:
-    response = requests.get(
+    response = _request(
+        "GET",
         f"{payload['base_url']}/api/v1/organizations",
         headers={
             "Content-Type": "application/json",
@@ -503,10 +727,23 @@ def get_organization(payload: dict) -> dict:
     )
 
     response.raise_for_status()
-    return response.json()["results"][0]
+    return _decode(response)["results"][0]
 
 
 def get_master_data_hub_credentials(payload: dict) -> tuple:
+    return _credentials_cache.get_or_load(
+        (payload["base_url"], token_fingerprint(payload["rossum_authorization_token"])),
+        lambda: resolve_master_data_hub_credentials(payload),
+    )
+
+
+def invalidate_master_data_hub_credentials(url: str, token: str | None) -> None:
+    """Forget every cached resolution to the MDH URL and token, e.g. after MDH rejected the token."""
+    _credentials_cache.invalidate_where(lambda credentials: credentials[:2] == (url, token))
+    _dataset_metadata_cache.invalidate((url, token_fingerprint(token)))
+
+
+def resolve_master_data_hub_credentials(payload: dict) -> tuple:
     is_api_develop = payload["base_url"].startswith("https://elis.develop.r8.lol") or payload["base_url"].startswith(
         "https://api.elis.develop.r8.lol"
     )
@@ -525,18 +762,139 @@ def get_master_data_hub_credentials(payload: dict) -> tuple:
         return (f"{payload['base_url']}/svc/master-data-hub/api", payload["rossum_authorization_token"], "")
 
 
+class QueryTemplate:
+    """
+    The "queries" JSON of a queue_lookup_aggregate field, parsed once.
+
+    The path of every "$$placeholder" string in each aggregate pipeline is recorded up front, so that filling
+    placeholders copies only the containers along those paths and shares the rest of the parsed pipeline.
+    """
+
+    def __init__(self, queries: str) -> None:
+        self.error: str | None = None
+        # (query index, query, aggregate pipeline or None, placeholder slots as (path, name))
+        self.queries: list[tuple[int, Any, Any, list[tuple[tuple, str]]]] = []
+
+        try:
+            parsed = json.loads(queries)
+        except Exception as e:
+            self.error = str(e)
+            return
+
+        for query_index, query in enumerate(parsed):
+            aggregate = query.get("aggregate")
+            slots: list[tuple[tuple, str]] = []
+            if aggregate:
+                self._collect_slots(aggregate, (), slots)
+            self.queries.append((query_index, query, aggregate or None, slots))
+
+    @classmethod
+    def _collect_slots(cls, value: Any, path: tuple, slots: list[tuple[tuple, str]]) -> None:
+        if isinstance(value, dict):
+            for k, v in value.items():
+                cls._collect_slots(v, (*path, k), slots)
+        elif isinstance(value, list):
+            for i, v in enumerate(value):
+                cls._collect_slots(v, (*path, i), slots)
+        elif isinstance(value, str) and value.startswith("$$"):
+            slots.append((path, value[2:]))
+
+    @staticmethod
+    def fill(aggregate: Any, slots: list[tuple[tuple, str]], placeholders: dict) -> Any:
+        """Return the aggregate with known placeholders substituted. Unknown "$$" strings are kept as they are."""
+        slots = [(path, name) for path, name in slots if name in placeholders]
+        if not slots:
+            return aggregate
+
+        copies: dict[tuple, Any] = {}
+
+        def copy_of(path: tuple, value: Any) -> Any:
+            if path not in copies:
+                copies[path] = dict(value) if isinstance(value, dict) else list(value)
+            return copies[path]
+
+        for path, name in slots:
+            if not path:
+                return placeholders[name]
+
+            container = copy_of((), aggregate)
+            for depth in range(1, len(path)):
+                child = copy_of(path[:depth], container[path[depth - 1]])
+                container[path[depth - 1]] = child
+                container = child
+            container[path[-1]] = placeholders[name]
+
+        return copies[()]
+
+
+_query_templates: OrderedDict[str, QueryTemplate] = OrderedDict()
+_query_templates_lock = threading.Lock()
+
+
+def get_query_template(queries: str) -> QueryTemplate:
+    """Return the compiled template of the queries, from a bounded cache keyed by the hash of their content."""
+    if not isinstance(queries, str):
+        # Not cacheable by content, the template reports why json.loads rejected it
+        return QueryTemplate(queries)
+
+    key = hashlib.sha256(queries.encode("utf-8")).hexdigest()
+    with _query_templates_lock:
+        if key in _query_templates:
+            _query_templates.move_to_end(key)
+            return _query_templates[key]
+
+    template = QueryTemplate(queries)
+    if template.error:
+        log.warning("Aggregation queries could not be parsed: %s", template.error)
+
+    with _query_templates_lock:
+        _query_templates[key] = template
+        while len(_query_templates) > QUERY_TEMPLATE_CACHE_SIZE:
+            _query_templates.popitem(last=False)
+    return template
+
+
+def iterate_query_results(calls: list[Callable[[], dict]], max_in_flight: int) -> Iterator[dict]:
+    """
+    Yield the results of the fallback query calls in their original order.
+
+    With max_in_flight <= 1 each call is made lazily, only once the previous result has been consumed.
+    Otherwise up to max_in_flight calls are sent speculatively at once and whatever is still pending
+    is cancelled (or ignored, if already in flight) once the consumer stops iterating.
+    """
+    if max_in_flight <= 1 or len(calls) <= 1:
+        for call in calls:
+            yield call()
+        return
+
+    executor = ThreadPoolExecutor(max_workers=min(max_in_flight, len(calls)))
+    try:
+        # Run each call in a copy of the current context, so that its timings are recorded too
+        futures = [executor.submit(copy_context().run, call) for call in calls]
+        for future in futures:
+            yield future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+@_instrumented
 def rossum_hook_request_handler(payload: dict) -> dict:
     variant = payload["variant"]
     configure = payload["configure"]
+    # Opt-in: send up to this many fallback queries at once instead of one after another.
+    max_in_flight = int((payload.get("settings") or {}).get("max_concurrent_queries", 1) or 1)
 
-    url, token, is_dev = get_master_data_hub_credentials(payload)
+    with _phase("credentials"):
+        url, token, is_dev = get_master_data_hub_credentials(payload)
 
     messages = []
 
     def aggregate_data(dataset: str, aggregate: list[dict]) -> dict:
         """Aggregate data from the API"""
-        response = requests.post(
+        response = _request(
+            "POST",
             f"{url}/v1/data/aggregate",
+            idempotent=True,
             headers={"Content-Type": "application/json", "Authorization": f"Bearer {token}", "X-ROSSUM-DEV": is_dev},
             json={
                 "aggregate": aggregate,
@@ -547,8 +905,11 @@ def rossum_hook_request_handler(payload: dict) -> dict:
             },
         )
 
+        if response.status_code in (401, 403):
+            invalidate_master_data_hub_credentials(url, token)
+
         response.raise_for_status()
-        return response.json()
+        return _decode(response)
 
     def filters_to_mongo_pipeline(sort: dict, limit: int, filters: list[dict]) -> list[dict]:
         find_filters = []
@@ -588,12 +949,21 @@ def rossum_hook_request_handler(payload: dict) -> dict:
 
     def find_tables() -> list[dict]:
         """Find available tables"""
-        response = requests.get(
-            f"{url}/v2/datasets/metadata", headers={"Authorization": f"Bearer {token}", "X-ROSSUM-DEV": is_dev}
-        )
 
-        response.raise_for_status()
-        return response.json()
+        def fetch_tables() -> list[dict]:
+            response = _request(
+                "GET",
+                f"{url}/v2/datasets/metadata",
+                headers={"Authorization": f"Bearer {token}", "X-ROSSUM-DEV": is_dev},
+            )
+
+            if response.status_code in (401, 403):
+                invalidate_master_data_hub_credentials(url, token)
+
+            response.raise_for_status()
+            return _decode(response)
+
+        return _dataset_metadata_cache.get_or_load((url, token_fingerprint(token)), fetch_tables)
 
     if variant == "queue_lookup":
         if configure:
@@ -615,23 +985,26 @@ def rossum_hook_request_handler(payload: dict) -> dict:
             value_key = payload["payload"]["value_key"]
             label_key = payload["payload"]["label_key"]
 
-            for query in queries:
-                if len(results) == 0:
-                    pipeline = filters_to_mongo_pipeline(sort, limit, query["filters"])
-                    data = aggregate_data(dataset, pipeline)
-                    results = data["results"]
-                else:
+            calls = [
+                partial(aggregate_data, dataset, filters_to_mongo_pipeline(sort, limit, query["filters"]))
+                for query in queries
+            ]
+
+            for data in iterate_query_results(calls, max_in_flight):
+                results = data["results"]
+                if results:
                     break
 
-            options: list[dict[str, Any]] = []
+            with _phase("shaping"):
+                options: list[dict[str, Any]] = []
 
-            for result in results:
-                options.append(
-                    {
-                        "value": str(result[value_key]),
-                        "label": str(result[label_key]),
-                    }
-                )
+                for result in results:
+                    options.append(
+                        {
+                            "value": str(result[value_key]),
+                            "label": str(result[label_key]),
+                        }
+                    )
 
             return {
                 "options": options,
@@ -671,19 +1044,6 @@ def rossum_hook_request_handler(payload: dict) -> dict:
             }
         else:
 
-            def _replaces(value: Any, placeholders: dict) -> Any:
-                if isinstance(value, dict):
-                    return {k: _replaces(v, placeholders) for k, v in value.items()}
-                if isinstance(value, list):
-                    return [_replaces(v, placeholders) for v in value]
-
-                if isinstance(value, str) and value.startswith("$$"):
-                    placeholder = value[2:]
-                    if placeholder in placeholders:
-                        return placeholders[placeholder]
-
-                return value
-
             queries = payload["payload"].get("queries", None)
             value_key = payload["payload"].get("value_key", None)
             label_key = payload["payload"].get("label_key", None)
@@ -696,12 +1056,12 @@ def rossum_hook_request_handler(payload: dict) -> dict:
                     "messages": messages,
                 }
 
-            try:
-                queries = json.loads(queries)
-            except Exception as e:
+            with _phase("parse"):
+                template = get_query_template(queries)
+            if template.error:
                 messages.extend(
                     [
-                        {"type": "error", "id": "all", "content": str(e)},
+                        {"type": "error", "id": "all", "content": template.error},
                         {"type": "error", "id": "all", "content": queries},
                     ]
                 )
@@ -719,18 +1079,20 @@ def rossum_hook_request_handler(payload: dict) -> dict:
                     placeholders[placeholder] = placeholders[placeholder]["__formula"]
                 # If it's already a string, keep it as is
 
-            for query_index, query in enumerate(queries):
-                if not (aggregate := query.get("aggregate")):
+            aggregates: list[tuple[int, list[dict]]] = []
+            for query_index, query, aggregate, slots in template.queries:
+                if not aggregate:
                     messages.append(
                         {"type": "info", "id": "all", "content": f"Non-aggregate queries are not supported: {query}"}
                     )
                     continue
 
-                agg = _replaces(aggregate, placeholders)
+                aggregates.append((query_index, QueryTemplate.fill(aggregate, slots, placeholders)))
 
-                # messages.append({"type": "info", "id": "all", "content": str(agg)})
+            calls = [partial(aggregate_data, payload["payload"]["dataset"], agg) for _, agg in aggregates]
 
-                data = aggregate_data(payload["payload"]["dataset"], agg)
+            for (query_index, agg), data in zip(aggregates, iterate_query_results(calls, max_in_flight)):
+                # messages.append({"type": "info", "id": "all", "content": str(agg)})
 
                 if "message" in data:
                     messages.append({"type": "error", "id": "all", "content": data["message"]})
@@ -740,27 +1102,28 @@ def rossum_hook_request_handler(payload: dict) -> dict:
                     # messages.append({"type": "info", "id": "all", "content": str(data)})
                     continue
 
-                options = []
-                for result in data["results"]:
-                    if "value" in result and "label" in result:
-                        struct: dict[str, Any] = {
-                            **{k: v for k, v in result.items() if k not in ("value", "label")},
-                            "__query_index": query_index,
-                        }
-                        options.append(
-                            {
-                                "value": result["value"],
-                                "label": result["label"],
-                                "struct": struct,
-                            }
-                        )
-                    elif value_key in result and label_key in result:
-                        options.append(
-                            {
-                                "value": result[value_key],
-                                "label": result[label_key],
+                with _phase("shaping"):
+                    options = []
+                    for result in data["results"]:
+                        if "value" in result and "label" in result:
+                            struct: dict[str, Any] = {
+                                **{k: v for k, v in result.items() if k not in ("value", "label")},
+                                "__query_index": query_index,
                             }
-                        )
+                            options.append(
+                                {
+                                    "value": result["value"],
+                                    "label": result["label"],
+                                    "struct": struct,
+                                }
+                            )
+                        elif value_key in result and label_key in result:
+                            options.append(
+                                {
+                                    "value": result[value_key],
+                                    "label": result[label_key],
+                                }
+                            )
 
                 selected = options[0]
                 if selected:
@@ -1,23 +1,240 @@
 # flake8: noqa
-import io
+import atexit
+import hashlib
+import http.cookiejar
 import json
 import logging
 import re
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime, timezone
-from typing import Any
+from functools import wraps
+from typing import Any, Callable, Hashable, Iterator
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 
 log = logging.getLogger(__name__)
 
 DEFAULT_TIMEOUT = 30
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+MAX_RETRY_DELAY = 5
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+MAX_CONNECTIONS_PER_HOST = 10
 KEY_COLUMN = "memory_key"
 VALUE_COLUMN = "value"
 CREATED_AT_COLUMN = "created_at"
+DEFAULT_LEARN_FLUSH_INTERVAL = 2
+LEARN_MAX_ATTEMPTS = 3
+CREDENTIALS_TTL = 300
+TTL_CACHE_SIZE = 256
+
+
+# Module level, so that a warm worker keeps its keep-alive connections between invocations.
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+_host_slots: dict[str, threading.BoundedSemaphore] = {}
+
+
+def _get_session() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            # Share connections only: invocations of other organizations must never be sent cookies set for this one
+            _session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            adapter = HTTPAdapter(pool_maxsize=MAX_CONNECTIONS_PER_HOST)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def _get_host_slot(url: str) -> threading.BoundedSemaphore:
+    host = urlsplit(url).netloc
+    with _session_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+        return _host_slots[host]
+
+
+def _request(
+    method: str, url: str, max_retries: int = MAX_RETRIES, idempotent: bool | None = None, **kwargs: Any
+) -> requests.Response:
+    """
+    Send a request over the pooled session, retrying with backoff.
+
+    Idempotent requests (by method, or as declared by the caller) are retried on connection errors and
+    429/5xx responses. Other requests are retried only when they cannot have been processed, i.e. on a
+    connect timeout or a 429, so that e.g. an insert is never applied twice.
+    """
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+    retry_errors = requests.exceptions.ConnectionError if idempotent else requests.exceptions.ConnectTimeout
+    retry_status_codes = RETRY_STATUS_CODES if idempotent else (429,)
+    session = _get_session()
+    host_slot = _get_host_slot(url)
+
+    attempt = 0
+    while True:
+        try:
+            with host_slot, _phase("network"):
+                response = session.request(method, url, **kwargs)
+        except retry_errors:
+            if attempt >= max_retries:
+                raise
+            delay = RETRY_BACKOFF * 2**attempt
+        else:
+            if response.status_code not in retry_status_codes or attempt >= max_retries:
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            delay = float(retry_after) if retry_after.isdigit() else RETRY_BACKOFF * 2**attempt
+            response.close()
+
+        # Back off outside of the host slot, so that other callers to the host are not held up
+        time.sleep(min(delay, MAX_RETRY_DELAY))
+        attempt += 1
+
+
+# Per-phase timings of the current invocation in milliseconds, None unless the "timings" setting is on
+_timings: ContextVar[dict[str, float] | None] = ContextVar("timings", default=None)
+# Phases may be timed from worker threads of the same invocation, e.g. concurrent queries
+_timings_lock = threading.Lock()
+
+
+@contextmanager
+def _phase(name: str) -> Iterator[None]:
+    """Add the time spent in the block to the timings of the current invocation, if they are recorded."""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        with _timings_lock:
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def _instrumented(handler: Callable[[dict], Any]) -> Callable[[dict], Any]:
+    """
+    Record per-phase timings of an invocation when the "timings" setting is "response" or "log".
+
+    Phases are cumulative and may nest or overlap, e.g. concurrent network calls or a network call
+    made while computing an embedding. "total" is the wall time of the whole invocation.
+    """
+
+    @wraps(handler)
+    def wrapper(payload: dict) -> Any:
+        mode = (payload.get("settings") or {}).get("timings")
+        if mode not in ("response", "log"):
+            return handler(payload)
+
+        timings: dict[str, float] = {}
+        reset_token = _timings.set(timings)
+        try:
+            with _phase("total"):
+                result = handler(payload)
+        finally:
+            _timings.reset(reset_token)
+
+        timings = {name: round(milliseconds, 3) for name, milliseconds in timings.items()}
+        if mode == "response" and isinstance(result, dict):
+            result["timings"] = timings
+        else:
+            log.info("Hook timings", extra={"timings": timings})
+        return result
+
+    return wrapper
+
+
+def _decode(response: requests.Response) -> Any:
+    with _phase("decode"):
+        return response.json()
+
+
+class _TTLCache:
+    """
+    Thread-safe cache whose entries expire ttl seconds after they were loaded.
+
+    Concurrent misses of the same key wait for a single load instead of each calling the loader.
+    Failed loads are not cached. Expired entries are purged on insert and at most max_entries are kept,
+    dropping the oldest loads first.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = TTL_CACHE_SIZE) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: dict[Hashable, tuple[float, Any]] = {}
+        self._loading: dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+
+            future = self._loading.get(key)
+            is_loader = future is None
+            if is_loader:
+                future = self._loading[key] = Future()
+
+        if not is_loader:
+            return future.result()
+
+        try:
+            value = loader()
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            now = time.monotonic()
+            expired = [cached_key for cached_key, (expires_at, _) in self._entries.items() if expires_at <= now]
+            for cached_key in expired:
+                del self._entries[cached_key]
+            # Re-insert, so that the entries stay ordered by load time
+            self._entries.pop(key, None)
+            self._entries[key] = (now + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+            del self._loading[key]
+        future.set_result(value)
+        return value
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate: Callable[[Any], bool]) -> None:
+        with self._lock:
+            for key in [key for key, (_, value) in self._entries.items() if predicate(value)]:
+                del self._entries[key]
+
+
+def _token_fingerprint(token: str | None) -> str:
+    return hashlib.sha256((token or "").encode("utf-8")).hexdigest()[:16]
+
+
+# Shared by all invocations of a warm worker, keyed by base URL and a fingerprint of the token
+_credentials_cache = _TTLCache(CREDENTIALS_TTL)
 
 
 def _get_organization(payload: dict) -> dict:
-    response = requests.get(
+    response = _request(
+        "GET",
         f"{payload['base_url']}/api/v1/organizations",
         headers={
             "Content-Type": "application/json",
@@ -26,10 +243,22 @@ def _get_organization(payload: dict) -> dict:
     )
 
     response.raise_for_status()
-    return response.json()["results"][0]
+    return _decode(response)["results"][0]
 
 
 def _get_master_data_hub_credentials(payload: dict) -> tuple[str, str | None, str]:
+    return _credentials_cache.get_or_load(
+        (payload["base_url"], _token_fingerprint(payload["rossum_authorization_token"])),
+        lambda: _resolve_master_data_hub_credentials(payload),
+    )
+
+
+def _invalidate_master_data_hub_credentials(mdh_url: str, token: str | None) -> None:
+    """Forget every cached resolution to the MDH URL and token, e.g. after MDH rejected the token."""
+    _credentials_cache.invalidate_where(lambda credentials: credentials[:2] == (mdh_url, token))
+
+
+def _resolve_master_data_hub_credentials(payload: dict) -> tuple[str, str | None, str]:
     is_api_develop = payload["base_url"].startswith("https://elis.develop.r8.lol") or payload["base_url"].startswith(
         "https://api.elis.develop.r8.lol"
     )
@@ -48,6 +277,139 @@ def _get_master_data_hub_credentials(payload: dict) -> tuple[str, str | None, st
         return (f"{payload['base_url']}/svc/master-data-hub/api", payload["rossum_authorization_token"], "")
 
 
+class _LearnBuffer:
+    """
+    Coalesces learned records of one dataset into a single upload, on behalf of a single MDH token.
+
+    The buffer is flushed once batch_size distinct keys are pending or flush_interval seconds after the
+    first pending record, whichever comes first. A later write to the same memory_key replaces the earlier one.
+    Pending records are uploaded in chunks of batch_size. Records of an upload that failed transiently are
+    queued again for the next flush, and dropped after LEARN_MAX_ATTEMPTS failed uploads.
+    """
+
+    def __init__(self, mdh_url: str, token: str | None, is_dev: str, dataset: str) -> None:
+        self.mdh_url = mdh_url
+        self.token = token
+        self.is_dev = is_dev
+        self.dataset = dataset
+        self.batch_size = 1
+        self.flush_interval = DEFAULT_LEARN_FLUSH_INTERVAL
+        self._pending: dict[str, dict] = {}
+        self._in_flight: dict[str, dict] = {}
+        # Failed uploads of the pending record of a memory_key
+        self._attempts: dict[str, int] = {}
+        self._timer: threading.Timer | None = None
+        self._lock = threading.Lock()
+
+    def add(self, records: list[dict]) -> None:
+        with self._lock:
+            for record in records:
+                self._pending.pop(record[KEY_COLUMN], None)
+                self._pending[record[KEY_COLUMN]] = record
+                self._attempts.pop(record[KEY_COLUMN], None)
+
+            is_full = len(self._pending) >= self.batch_size
+            if not is_full:
+                self._schedule()
+
+        if is_full:
+            self.flush()
+
+    def get(self, memory_key: str) -> dict | None:
+        """Return a record that was learned but not yet uploaded, so that retrieve sees its own writes."""
+        with self._lock:
+            return self._pending.get(memory_key) or self._in_flight.get(memory_key)
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            records, self._pending = self._pending, {}
+            self._in_flight.update(records)
+
+        items = list(records.items())
+        chunk_size = max(self.batch_size, 1)
+        for start in range(0, len(items), chunk_size):
+            self._upload(dict(items[start : start + chunk_size]))
+
+    def _upload(self, records: dict[str, dict]) -> None:
+        retry = False
+        try:
+            _upload(self.mdh_url, self.token, self.is_dev, self.dataset, list(records.values()))
+            log.info(
+                "Master Data Hub memory batched learn successful",
+                extra={"dataset": self.dataset, "count": len(records)},
+            )
+        except requests.exceptions.RequestException as e:
+            # Client errors such as a rejected token would fail again, everything else is worth another try
+            status_code = e.response.status_code if e.response is not None else None
+            retry = status_code is None or status_code == 429 or status_code >= 500
+            log.exception(
+                "Master Data Hub memory batched learn failed",
+                extra={"dataset": self.dataset, "memory_keys": list(records), "retry": retry},
+            )
+        finally:
+            dropped = []
+            with self._lock:
+                for memory_key, record in records.items():
+                    if self._in_flight.get(memory_key) is not record:
+                        continue
+                    del self._in_flight[memory_key]
+                    if not retry:
+                        self._attempts.pop(memory_key, None)
+                        continue
+                    # A newer pending write to the same key supersedes the failed one
+                    if memory_key in self._pending:
+                        continue
+                    attempts = self._attempts.pop(memory_key, 0) + 1
+                    if attempts < LEARN_MAX_ATTEMPTS:
+                        self._pending[memory_key] = record
+                        self._attempts[memory_key] = attempts
+                    else:
+                        dropped.append(memory_key)
+                if retry and self._pending:
+                    self._schedule()
+
+            if dropped:
+                log.error(
+                    "Master Data Hub memory batched learn gave up",
+                    extra={"dataset": self.dataset, "memory_keys": dropped, "attempts": LEARN_MAX_ATTEMPTS},
+                )
+
+    def _schedule(self) -> None:
+        """Arm the flush timer unless it is already running. Callers must hold the lock."""
+        if self._timer is None:
+            self._timer = threading.Timer(self.flush_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+
+# Keyed by MDH URL, a fingerprint of the token and dataset, so that records are only uploaded and read back
+# with the token that learned them
+_learn_buffers: dict[tuple[str, str, str], _LearnBuffer] = {}
+_learn_buffers_lock = threading.Lock()
+
+
+def _get_learn_buffer(
+    mdh_url: str, token: str | None, is_dev: str, dataset: str, create: bool = True
+) -> _LearnBuffer | None:
+    with _learn_buffers_lock:
+        key = (mdh_url, _token_fingerprint(token), dataset)
+        if key not in _learn_buffers and create:
+            _learn_buffers[key] = _LearnBuffer(mdh_url, token, is_dev, dataset)
+        return _learn_buffers.get(key)
+
+
+@atexit.register
+def _flush_learn_buffers() -> None:
+    with _learn_buffers_lock:
+        buffers = list(_learn_buffers.values())
+    for buffer in buffers:
+        buffer.flush()
+
+
+@_instrumented
 def rossum_hook_request_handler(payload: dict) -> dict[str, Any]:
     """
     Master Data Hub memory provider for memory fields.
@@ -66,13 +428,22 @@ def rossum_hook_request_handler(payload: dict) -> dict[str, Any]:
             "key": "memory_key_value",
             "value": "...",  # only for learn
             "struct": {...},  # only for learn
+            "keys": ["...", ...],  # optional, retrieve many keys with a single aggregate
+            "items": [{"key": "...", "value": "...", "struct": {...}}, ...],  # optional, learn many keys at once
             "dataset": "dataset_name",  # required
         },
+        "settings": {
+            "learn_batch_size": 50,  # optional, coalesce learns of a dataset into uploads of this many keys
+            "learn_flush_interval": 2,  # optional, seconds before a partial batch is uploaded anyway
+        },
         "variant": "retrieve" | "learn" | "configure",
     }
+
+    A bulk retrieve returns {"results": {memory_key: {"value": ..., "struct": ..., "found": ...}}}.
     """
     variant = payload.get("variant", "retrieve")
     inner_payload = payload.get("payload", {})
+    settings = payload.get("settings", {})
     mode = inner_payload.get("mode", variant)
 
     if mode == "configure":
@@ -95,29 +466,50 @@ def rossum_hook_request_handler(payload: dict) -> dict[str, Any]:
             }
         }
 
-    url, token, is_dev = _get_master_data_hub_credentials(payload)
+    with _phase("credentials"):
+        url, token, is_dev = _get_master_data_hub_credentials(payload)
     dataset = inner_payload.get("dataset")
     memory_key = inner_payload.get("key")
+    memory_keys = inner_payload.get("keys")
+    items = inner_payload.get("items")
 
     if not dataset:
         log.warning("Master Data Hub memory: dataset not specified")
         return {"value": None, "struct": None, "found": False}
 
-    if not memory_key:
-        log.warning("Master Data Hub memory: key not specified")
-        return {"value": None, "struct": None, "found": False}
-
     if mode == "learn":
+        if not items:
+            items = [{"key": memory_key, "value": inner_payload.get("value"), "struct": inner_payload.get("struct")}]
+
+        if not all(item.get("key") for item in items):
+            log.warning("Master Data Hub memory: key not specified")
+            return {}
+
         return _learn(
             mdh_url=url,
             token=token,
             is_dev=is_dev,
             dataset=dataset,
-            memory_key=memory_key,
-            value=inner_payload.get("value"),
-            struct=inner_payload.get("struct"),
+            items=items,
+            batch_size=int(settings.get("learn_batch_size", 1)),
+            flush_interval=float(settings.get("learn_flush_interval", DEFAULT_LEARN_FLUSH_INTERVAL)),
         )
 
+    if memory_keys:
+        return {
+            "results": _retrieve_many(
+                mdh_url=url,
+                token=token,
+                is_dev=is_dev,
+                dataset=dataset,
+                memory_keys=memory_keys,
+            )
+        }
+
+    if not memory_key:
+        log.warning("Master Data Hub memory: key not specified")
+        return {"value": None, "struct": None, "found": False}
+
     return _retrieve(
         mdh_url=url,
         token=token,
@@ -127,6 +519,20 @@ def rossum_hook_request_handler(payload: dict) -> dict[str, Any]:
     )
 
 
+def _to_memory(record: dict | None) -> dict[str, Any]:
+    if record is None:
+        return {"value": None, "struct": None, "found": False}
+
+    value = record.get(VALUE_COLUMN)
+    struct = {k: v for k, v in record.items() if k not in (KEY_COLUMN, VALUE_COLUMN, CREATED_AT_COLUMN, "_id")}
+
+    return {
+        "value": value,
+        "struct": struct if struct else None,
+        "found": True,
+    }
+
+
 def _retrieve(
     mdh_url: str,
     token: str | None,
@@ -135,14 +541,39 @@ def _retrieve(
     memory_key: str,
 ) -> dict[str, Any]:
     """Retrieve memory data from Master Data Hub using aggregate query."""
+    return _retrieve_many(mdh_url, token, is_dev, dataset, [memory_key])[memory_key]
+
+
+def _retrieve_many(
+    mdh_url: str,
+    token: str | None,
+    is_dev: str,
+    dataset: str,
+    memory_keys: list[str],
+) -> dict[str, dict[str, Any]]:
+    """Retrieve memory data for many keys from Master Data Hub using a single $in aggregate query."""
+    records: dict[str, dict | None] = dict.fromkeys(memory_keys)
+
+    # Records learned in this worker but not uploaded yet take precedence over the dataset
+    if buffer := _get_learn_buffer(mdh_url, token, is_dev, dataset, create=False):
+        for memory_key in records:
+            records[memory_key] = buffer.get(memory_key)
+
+    missing = [memory_key for memory_key, record in records.items() if record is None]
+
+    if not missing:
+        with _phase("shaping"):
+            return {memory_key: _to_memory(record) for memory_key, record in records.items()}
+
     try:
         aggregate = [
-            {"$match": {KEY_COLUMN: {"$eq": memory_key}}},
-            {"$limit": 1},
+            {"$match": {KEY_COLUMN: {"$in": missing}}},
         ]
 
-        response = requests.post(
+        response = _request(
+            "POST",
             f"{mdh_url}/v1/data/aggregate",
+            idempotent=True,
             headers={
                 "Content-Type": "application/json",
                 "Authorization": f"Bearer {token}",
@@ -158,32 +589,55 @@ def _retrieve(
             timeout=DEFAULT_TIMEOUT,
         )
 
-        if response.status_code == 404:
-            return {"value": None, "struct": None, "found": False}
-
-        response.raise_for_status()
-        data = response.json()
-        results = data.get("results", [])
+        if response.status_code in (401, 403):
+            _invalidate_master_data_hub_credentials(mdh_url, token)
 
-        if not results:
-            return {"value": None, "struct": None, "found": False}
-
-        record = results[0]
-        value = record.get(VALUE_COLUMN)
-        struct = {k: v for k, v in record.items() if k not in (KEY_COLUMN, VALUE_COLUMN, CREATED_AT_COLUMN, "_id")}
-
-        return {
-            "value": value,
-            "struct": struct if struct else None,
-            "found": True,
-        }
+        if response.status_code != 404:
+            response.raise_for_status()
+            for record in _decode(response).get("results", []):
+                memory_key = record.get(KEY_COLUMN)
+                if memory_key in records and records[memory_key] is None:
+                    records[memory_key] = record
 
     except requests.exceptions.RequestException:
         log.exception(
             "Master Data Hub memory retrieve failed",
-            extra={"dataset": dataset, "memory_key": memory_key},
+            extra={"dataset": dataset, "memory_keys": missing},
         )
-        return {"value": None, "struct": None, "found": False}
+
+    with _phase("shaping"):
+        return {memory_key: _to_memory(record) for memory_key, record in records.items()}
+
+
+def _upload(mdh_url: str, token: str | None, is_dev: str, dataset: str, records: list[dict]) -> None:
+    """Upsert records to Master Data Hub using PATCH with update_or_new, keyed by memory_key."""
+    # Raw bytes rather than a file object, so that the upload can be re-sent on retry
+    json_content = json.dumps(records).encode("utf-8")
+
+    response = _request(
+        "PATCH",
+        f"{mdh_url}/v1/dataset/{dataset}",
+        # update_or_new keyed by memory_key, so re-sending the upload is harmless
+        idempotent=True,
+        headers={
+            "Authorization": f"Bearer {token}",
+            "X-ROSSUM-DEV": is_dev,
+        },
+        files={
+            "file": ("memory_data.json", json_content, "application/json"),
+        },
+        data={
+            "encoding": "utf-8",
+            "update_or_new": "true",
+            "id_keys": KEY_COLUMN,
+        },
+        timeout=DEFAULT_TIMEOUT,
+    )
+
+    if response.status_code in (401, 403):
+        _invalidate_master_data_hub_credentials(mdh_url, token)
+
+    response.raise_for_status()
 
 
 def _learn(
@@ -191,50 +645,42 @@ def _learn(
     token: str | None,
     is_dev: str,
     dataset: str,
-    memory_key: str,
-    value: Any,
-    struct: dict | None,
+    items: list[dict],
+    batch_size: int = 1,
+    flush_interval: float = DEFAULT_LEARN_FLUSH_INTERVAL,
 ) -> dict[str, Any]:
-    """Store memory data to Master Data Hub using PATCH with update_or_new."""
-    try:
+    """Store memory data to Master Data Hub, either right away or coalesced with other learns when batching."""
+    created_at = datetime.now(timezone.utc).isoformat()
+    records: dict[str, dict] = {}
+    for item in items:
         record = {
-            KEY_COLUMN: memory_key,
-            VALUE_COLUMN: value,
-            CREATED_AT_COLUMN: datetime.now(timezone.utc).isoformat(),
+            KEY_COLUMN: item["key"],
+            VALUE_COLUMN: item.get("value"),
+            CREATED_AT_COLUMN: created_at,
         }
-        if struct:
-            record.update(struct)
-
-        json_content = json.dumps([record])
-        file_obj = io.BytesIO(json_content.encode("utf-8"))
-
-        response = requests.patch(
-            f"{mdh_url}/v1/dataset/{dataset}",
-            headers={
-                "Authorization": f"Bearer {token}",
-                "X-ROSSUM-DEV": is_dev,
-            },
-            files={
-                "file": ("memory_data.json", file_obj, "application/json"),
-            },
-            data={
-                "encoding": "utf-8",
-                "update_or_new": "true",
-                "id_keys": KEY_COLUMN,
-            },
-            timeout=DEFAULT_TIMEOUT,
-        )
+        if item.get("struct"):
+            record.update(item["struct"])
+        # Last write wins within a single bulk learn as well
+        records[item["key"]] = record
+
+    if batch_size > 1:
+        buffer = _get_learn_buffer(mdh_url, token, is_dev, dataset)
+        buffer.batch_size = batch_size
+        buffer.flush_interval = flush_interval
+        buffer.add(list(records.values()))
+        return {}
 
-        response.raise_for_status()
+    try:
+        _upload(mdh_url, token, is_dev, dataset, list(records.values()))
         log.info(
             "Master Data Hub memory learn successful",
-            extra={"dataset": dataset, "memory_key": memory_key},
+            extra={"dataset": dataset, "memory_keys": list(records)},
         )
         return {}
 
     except requests.exceptions.RequestException:
         log.exception(
             "Master Data Hub memory learn failed",
-            extra={"dataset": dataset, "memory_key": memory_key},
+            extra={"dataset": dataset, "memory_keys": list(records)},
         )
         return {}
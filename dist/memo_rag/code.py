@@ -1,19 +1,526 @@
 # flake8: noqa
+import hashlib
+import http.cookiejar
 import json
 import logging
+import mmap
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime, timezone
-from typing import Any
+from functools import wraps
+from typing import Any, Callable, Iterator
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import numpy as np
+except ImportError:  # The local index is optional, retrieve then always uses the Supabase RPC
+    np = None
 
 log = logging.getLogger(__name__)
 
 DEFAULT_TIMEOUT = 30
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+MAX_RETRY_DELAY = 5
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+MAX_CONNECTIONS_PER_HOST = 10
 DEFAULT_MATCH_COUNT = 3
 EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
 HUGGINGFACE_API_URL = f"https://router.huggingface.co/hf-inference/models/{EMBEDDING_MODEL}/pipeline/feature-extraction"
+DEFAULT_EMBEDDING_CACHE_SIZE = 1024
+DEFAULT_EMBEDDING_CACHE_DISK_ENTRIES = 100_000
+DEFAULT_LOCAL_INDEX_TTL = 300
+DEFAULT_LOCAL_INDEX_MAX_ROWS = 300_000
+LOCAL_INDEX_PAGE_SIZE = 1000
+LOCAL_INDEX_REBUILD_INTERVAL = 3600
+
+
+# Module level, so that a warm worker keeps its keep-alive connections between invocations.
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+_host_slots: dict[str, threading.BoundedSemaphore] = {}
+
+
+def _get_session() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            # Share connections only: invocations of other organizations must never be sent cookies set for this one
+            _session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            adapter = HTTPAdapter(pool_maxsize=MAX_CONNECTIONS_PER_HOST)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def _get_host_slot(url: str) -> threading.BoundedSemaphore:
+    host = urlsplit(url).netloc
+    with _session_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+        return _host_slots[host]
+
+
+def _request(
+    method: str, url: str, max_retries: int = MAX_RETRIES, idempotent: bool | None = None, **kwargs: Any
+) -> requests.Response:
+    """
+    Send a request over the pooled session, retrying with backoff.
+
+    Idempotent requests (by method, or as declared by the caller) are retried on connection errors and
+    429/5xx responses. Other requests are retried only when they cannot have been processed, i.e. on a
+    connect timeout or a 429, so that e.g. an insert is never applied twice.
+    """
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+    retry_errors = requests.exceptions.ConnectionError if idempotent else requests.exceptions.ConnectTimeout
+    retry_status_codes = RETRY_STATUS_CODES if idempotent else (429,)
+    session = _get_session()
+    host_slot = _get_host_slot(url)
+
+    attempt = 0
+    while True:
+        try:
+            with host_slot, _phase("network"):
+                response = session.request(method, url, **kwargs)
+        except retry_errors:
+            if attempt >= max_retries:
+                raise
+            delay = RETRY_BACKOFF * 2**attempt
+        else:
+            if response.status_code not in retry_status_codes or attempt >= max_retries:
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            delay = float(retry_after) if retry_after.isdigit() else RETRY_BACKOFF * 2**attempt
+            response.close()
+
+        # Back off outside of the host slot, so that other callers to the host are not held up
+        time.sleep(min(delay, MAX_RETRY_DELAY))
+        attempt += 1
+
+
+# Per-phase timings of the current invocation in milliseconds, None unless the "timings" setting is on
+_timings: ContextVar[dict[str, float] | None] = ContextVar("timings", default=None)
+# Phases may be timed from worker threads of the same invocation, e.g. concurrent queries
+_timings_lock = threading.Lock()
+
+
+@contextmanager
+def _phase(name: str) -> Iterator[None]:
+    """Add the time spent in the block to the timings of the current invocation, if they are recorded."""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        with _timings_lock:
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def _instrumented(handler: Callable[[dict], Any]) -> Callable[[dict], Any]:
+    """
+    Record per-phase timings of an invocation when the "timings" setting is "response" or "log".
+
+    Phases are cumulative and may nest or overlap, e.g. concurrent network calls or a network call
+    made while computing an embedding. "total" is the wall time of the whole invocation.
+    """
+
+    @wraps(handler)
+    def wrapper(payload: dict) -> Any:
+        mode = (payload.get("settings") or {}).get("timings")
+        if mode not in ("response", "log"):
+            return handler(payload)
+
+        timings: dict[str, float] = {}
+        reset_token = _timings.set(timings)
+        try:
+            with _phase("total"):
+                result = handler(payload)
+        finally:
+            _timings.reset(reset_token)
+
+        timings = {name: round(milliseconds, 3) for name, milliseconds in timings.items()}
+        if mode == "response" and isinstance(result, dict):
+            result["timings"] = timings
+        else:
+            log.info("Hook timings", extra={"timings": timings})
+        return result
+
+    return wrapper
+
+
+def _decode(response: requests.Response) -> Any:
+    with _phase("decode"):
+        return response.json()
+
+
+class _EmbeddingCache:
+    """
+    Content-addressed cache of embedding vectors, keyed by model name and whitespace-normalized text.
+
+    Vectors live in a bounded in-memory LRU and, when a directory is configured, also on disk as raw
+    float32 files that are memory-mapped on read, so that other workers on the same host can share them.
+    The disk tier is bounded too: reads refresh a file's mtime and the least recently used files are
+    pruned once the directory holds more than max_disk_entries vectors.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_EMBEDDING_CACHE_SIZE,
+        directory: str | None = None,
+        max_disk_entries: int = DEFAULT_EMBEDDING_CACHE_DISK_ENTRIES,
+    ) -> None:
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, array] = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes_since_prune: int | None = None
+
+    def configure(self, max_entries: int, directory: str | None, max_disk_entries: int) -> None:
+        with self._lock:
+            if directory != self.directory:
+                self._writes_since_prune = None
+            self.max_entries = max_entries
+            self.directory = directory
+            self.max_disk_entries = max_disk_entries
+            self._evict()
+
+    def get(self, model: str, text: str) -> list[float] | None:
+        key = self._key(model, text)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return vector.tolist()
+
+        vector = self._read(key)
+        with self._lock:
+            if vector is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, vector)
+        return vector.tolist()
+
+    def put(self, model: str, text: str, embedding: list[float]) -> None:
+        key = self._key(model, text)
+        vector = array("f", embedding)
+        with self._lock:
+            self._remember(key, vector)
+        self._write(key, vector)
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "size": len(self._entries)}
+
+    @staticmethod
+    def _key(model: str, text: str) -> str:
+        normalized = " ".join(text.split())
+        return hashlib.sha256(f"{model}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, vector: array) -> None:
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def _evict(self) -> None:
+        while len(self._entries) > max(self.max_entries, 0):
+            self._entries.popitem(last=False)
+
+    def _path(self, key: str) -> str | None:
+        return os.path.join(self.directory, f"{key}.f32") if self.directory else None
+
+    def _read(self, key: str) -> array | None:
+        if not (path := self._path(key)):
+            return None
+        try:
+            with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                vector = array("f")
+                vector.frombytes(mapped)
+            # Mark the vector as recently used for pruning
+            os.utime(path)
+            return vector
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, key: str, vector: array) -> None:
+        if not (path := self._path(key)):
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first, so that readers never map a partially written vector
+            temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary_path, "wb") as file:
+                vector.tofile(file)
+            os.replace(temporary_path, path)
+        except OSError:
+            log.warning("Embedding cache: failed to persist vector", exc_info=True)
+            return
+
+        # Listing the directory is not free, so prune on the first write and then every tenth of the limit
+        with self._lock:
+            if self._writes_since_prune is not None and self._writes_since_prune < max(self.max_disk_entries // 10, 1):
+                self._writes_since_prune += 1
+                return
+            self._writes_since_prune = 0
+        self._prune()
+
+    def _prune(self) -> None:
+        directory = self.directory
+        if not directory:
+            return
+        try:
+            files = [entry for entry in os.scandir(directory) if entry.name.endswith(".f32")]
+        except OSError:
+            return
+        if len(files) <= self.max_disk_entries:
+            return
+
+        def last_used(entry: os.DirEntry) -> float:
+            try:
+                return entry.stat().st_mtime
+            except OSError:
+                return 0.0
+
+        files.sort(key=last_used)
+        for entry in files[: len(files) - max(self.max_disk_entries, 0)]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                # Pruned concurrently by another worker
+                pass
+
+
+_embedding_cache = _EmbeddingCache()
+
+
+class _LocalIndex:
+    """
+    In-process copy of a Supabase embeddings table for cosine top-k search.
+
+    Rows are pulled incrementally by ascending id and rows learned in this worker are written through,
+    so a fresh index answers the same way as a match function ranking by cosine similarity. Incremental
+    syncs do not see rows updated or deleted in the table, so the index is rebuilt from scratch every
+    LOCAL_INDEX_REBUILD_INTERVAL seconds. After a failed sync, or when the table outgrows max_rows, no
+    sync is attempted for another ttl seconds and retrieve uses the match function meanwhile.
+
+    Every synced page is folded into the float32 matrix right away, so only one page of embeddings is
+    ever held as Python objects. The matrix grows geometrically, capped at max_rows.
+    """
+
+    def __init__(self, supabase_url: str, table_name: str) -> None:
+        self.supabase_url = supabase_url
+        self.table_name = table_name
+        self.ttl = DEFAULT_LOCAL_INDEX_TTL
+        self.max_rows = DEFAULT_LOCAL_INDEX_MAX_ROWS
+        self.loaded = False
+        self.synced_at = 0.0
+        self.rebuilt_at = 0.0
+        self.unavailable_until = 0.0
+        self.last_id: Any = None
+        self._ids: set = set()
+        self._contents: list[Any] = []
+        self._learned_values: list[Any] = []
+        # Rows beyond _size are preallocated capacity
+        self._matrix = np.empty((0, 0), dtype=np.float32)
+        self._size = 0
+        self._pending: list[Any] = []
+        # Rows written through while a rebuild is running, replayed into the rebuilt index
+        self._rebuild_log: list[tuple[Any, Any, Any, list[float]]] | None = None
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def is_fresh(self) -> bool:
+        return self.loaded and time.monotonic() - self.synced_at < self.ttl
+
+    def add(self, row_id: Any, content: Any, learned_value: Any, embedding: Any) -> None:
+        with self._lock:
+            if row_id in self._ids:
+                return
+            self._ids.add(row_id)
+            self._contents.append(content)
+            self._learned_values.append(learned_value)
+            self._pending.append(embedding)
+            if self._rebuild_log is not None:
+                self._rebuild_log.append((row_id, content, learned_value, embedding))
+
+    def search(self, embedding: list[float], match_count: int) -> list[dict[str, Any]]:
+        with self._lock:
+            matrix = self._build_matrix()
+            contents = self._contents
+            learned_values = self._learned_values
+
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if not len(matrix) or not norm or matrix.shape[1] != len(query):
+            return []
+
+        similarities = np.clip(matrix @ (query / norm), -1.0, 1.0)
+        count = min(max(int(match_count), 1), len(similarities))
+        top = np.argpartition(-similarities, count - 1)[:count]
+        top = top[np.argsort(-similarities[top])]
+        return [
+            {"content": contents[i], "learned_value": learned_values[i], "similarity": float(similarities[i])}
+            for i in top
+        ]
+
+    def refresh_in_background(self, supabase_key: str) -> None:
+        if self._sync_lock.locked() or time.monotonic() < self.unavailable_until:
+            return
+        threading.Thread(target=self.sync, args=(supabase_key,), daemon=True).start()
+
+    def sync(self, supabase_key: str) -> None:
+        """
+        Pull the rows added since the last sync, or all rows when a rebuild is due, into the index.
+        Concurrent calls are dropped while a sync is running.
+        """
+        if not self._sync_lock.acquire(blocking=False):
+            return
+        rebuild = not self.loaded or time.monotonic() - self.rebuilt_at >= LOCAL_INDEX_REBUILD_INTERVAL
+        # A rebuild fills a new index, so that the current one keeps serving retrieves meanwhile
+        target = _LocalIndex(self.supabase_url, self.table_name) if rebuild else self
+        if rebuild:
+            target.max_rows = self.max_rows
+            with self._lock:
+                self._rebuild_log = []
+        try:
+            while True:
+                params = {
+                    "select": "id,content,learned_value,embedding",
+                    "order": "id.asc",
+                    "limit": LOCAL_INDEX_PAGE_SIZE,
+                }
+                if target.last_id is not None:
+                    params["id"] = f"gt.{target.last_id}"
+
+                response = _request(
+                    "GET",
+                    f"{self.supabase_url}/rest/v1/{self.table_name}",
+                    headers={"apikey": supabase_key, "Authorization": f"Bearer {supabase_key}"},
+                    params=params,
+                )
+                response.raise_for_status()
+                rows = _decode(response)
+
+                if len(target._ids) + len(rows) > self.max_rows:
+                    log.warning(
+                        "Supabase RAG memory: table too large for the local index, using the match function",
+                        extra={"table_name": self.table_name, "max_rows": self.max_rows},
+                    )
+                    self._clear()
+                    self.unavailable_until = time.monotonic() + self.ttl
+                    return
+
+                for row in rows:
+                    # PostgREST serializes pgvector columns as a string, e.g. "[0.1,0.2,...]"
+                    embedding = row["embedding"]
+                    if isinstance(embedding, str):
+                        embedding = json.loads(embedding)
+                    target.add(
+                        row["id"], row.get("content"), row.get("learned_value"), np.asarray(embedding, dtype=np.float32)
+                    )
+                    target.last_id = row["id"]
+                with target._lock:
+                    target._build_matrix()
+
+                if len(rows) < LOCAL_INDEX_PAGE_SIZE:
+                    break
+
+            if rebuild:
+                with self._lock:
+                    for row_id, content, learned_value, embedding in self._rebuild_log:
+                        target.add(row_id, content, learned_value, embedding)
+                    self._ids = target._ids
+                    self._contents = target._contents
+                    self._learned_values = target._learned_values
+                    self._matrix = target._matrix
+                    self._size = target._size
+                    self._pending = target._pending
+                    self.last_id = target.last_id
+                self.rebuilt_at = time.monotonic()
+            self.loaded = True
+            self.synced_at = time.monotonic()
+        except (requests.exceptions.RequestException, KeyError, ValueError):
+            log.exception("Supabase RAG memory local index sync failed", extra={"table_name": self.table_name})
+            self.unavailable_until = time.monotonic() + self.ttl
+        finally:
+            with self._lock:
+                self._rebuild_log = None
+            self._sync_lock.release()
+
+    def _build_matrix(self) -> Any:
+        """Fold pending rows into the L2-normalized matrix and return its filled rows. Callers must hold the lock."""
+        if self._pending:
+            pending = np.asarray(self._pending, dtype=np.float32)
+            norms = np.linalg.norm(pending, axis=1, keepdims=True)
+            pending /= np.where(norms == 0, 1, norms)
+
+            size = self._size + len(pending)
+            if size > len(self._matrix):
+                # Earlier views returned to search keep referencing the previous array
+                capacity = max(min(2 * len(self._matrix), self.max_rows), size)
+                matrix = np.empty((capacity, pending.shape[1]), dtype=np.float32)
+                if self._size:
+                    matrix[: self._size] = self._matrix[: self._size]
+                self._matrix = matrix
+            self._matrix[self._size : size] = pending
+            self._size = size
+            self._pending = []
+        return self._matrix[: self._size]
+
+    def _clear(self) -> None:
+        with self._lock:
+            self.loaded = False
+            self.last_id = None
+            self._ids = set()
+            self._contents = []
+            self._learned_values = []
+            self._matrix = np.empty((0, 0), dtype=np.float32)
+            self._size = 0
+            self._pending = []
+
+
+_local_indexes: dict[tuple[str, str], _LocalIndex] = {}
+_local_indexes_lock = threading.Lock()
+
+
+def _get_local_index(supabase_url: str, table_name: str, ttl: float, max_rows: int) -> _LocalIndex | None:
+    if np is None:
+        log.warning("Supabase RAG memory: numpy is not available, local index disabled")
+        return None
+
+    with _local_indexes_lock:
+        key = (supabase_url, table_name)
+        if key not in _local_indexes:
+            _local_indexes[key] = _LocalIndex(supabase_url, table_name)
+        index = _local_indexes[key]
 
+    index.ttl = ttl
+    index.max_rows = max_rows
+    return index
 
+
+@_instrumented
 def rossum_hook_request_handler(payload: dict) -> dict[str, Any]:
     """
     Supabase/HuggingFace RAG memory provider for memory fields.
@@ -38,6 +545,12 @@ def rossum_hook_request_handler(payload: dict) -> dict[str, Any]:
             "table_name": "documents",  # optional, defaults to "documents"
             "match_function": "match_documents",  # optional, defaults to "match_documents"
             "match_count": 3,  # optional, defaults to 3
+            "embedding_cache_size": 1024,  # optional, in-memory embedding cache entries, defaults to 1024
+            "embedding_cache_dir": "/tmp/embeddings",  # optional, enables the on-disk embedding cache
+            "embedding_cache_disk_entries": 100000,  # optional, on-disk embedding cache entries, defaults to 100000
+            "local_index": false,  # optional, search an in-process copy of table_name (requires numpy)
+            "local_index_ttl": 300,  # optional, seconds before the local index is resynced
+            "local_index_max_rows": 300000,  # optional, larger tables always use match_function
         },
         "secrets": {
             "supabase_key": "...",
@@ -64,6 +577,12 @@ def rossum_hook_request_handler(payload: dict) -> dict[str, Any]:
                             {"type": "Control", "scope": "#/properties/match_function"},
                             {"type": "Control", "scope": "#/properties/match_count"},
                             {"type": "Control", "scope": "#/properties/similarity_threshold"},
+                            {"type": "Control", "scope": "#/properties/embedding_cache_size"},
+                            {"type": "Control", "scope": "#/properties/embedding_cache_dir"},
+                            {"type": "Control", "scope": "#/properties/embedding_cache_disk_entries"},
+                            {"type": "Control", "scope": "#/properties/local_index"},
+                            {"type": "Control", "scope": "#/properties/local_index_ttl"},
+                            {"type": "Control", "scope": "#/properties/local_index_max_rows"},
                         ],
                     },
                     "schema": {
@@ -74,6 +593,12 @@ def rossum_hook_request_handler(payload: dict) -> dict[str, Any]:
                             "match_function": {"type": "string"},
                             "match_count": {"type": "integer"},
                             "similarity_threshold": {"type": "number"},
+                            "embedding_cache_size": {"type": "integer"},
+                            "embedding_cache_dir": {"type": "string"},
+                            "embedding_cache_disk_entries": {"type": "integer"},
+                            "local_index": {"type": "boolean"},
+                            "local_index_ttl": {"type": "integer"},
+                            "local_index_max_rows": {"type": "integer"},
                         },
                     },
                 },
@@ -105,6 +630,12 @@ def rossum_hook_request_handler(payload: dict) -> dict[str, Any]:
     similarity_threshold = settings.get("similarity_threshold", 0)
     memory_key = inner_payload.get("key")
 
+    _embedding_cache.configure(
+        max_entries=int(settings.get("embedding_cache_size") or DEFAULT_EMBEDDING_CACHE_SIZE),
+        directory=settings.get("embedding_cache_dir"),
+        max_disk_entries=int(settings.get("embedding_cache_disk_entries") or DEFAULT_EMBEDDING_CACHE_DISK_ENTRIES),
+    )
+
     if not supabase_url or not supabase_key:
         log.warning("Supabase RAG memory: supabase_url or supabase_key not specified")
         return {"value": None, "struct": None, "found": False}
@@ -117,6 +648,17 @@ def rossum_hook_request_handler(payload: dict) -> dict[str, Any]:
         log.warning("Supabase RAG memory: key not specified")
         return {"value": None, "struct": None, "found": False}
 
+    local_index = (
+        _get_local_index(
+            supabase_url,
+            table_name,
+            ttl=float(settings.get("local_index_ttl") or DEFAULT_LOCAL_INDEX_TTL),
+            max_rows=int(settings.get("local_index_max_rows") or DEFAULT_LOCAL_INDEX_MAX_ROWS),
+        )
+        if settings.get("local_index")
+        else None
+    )
+
     if mode == "learn":
         return _learn(
             supabase_url=supabase_url,
@@ -126,6 +668,7 @@ def rossum_hook_request_handler(payload: dict) -> dict[str, Any]:
             memory_key=memory_key,
             value=inner_payload.get("value"),
             struct=inner_payload.get("struct"),
+            local_index=local_index,
         )
 
     return _retrieve(
@@ -136,14 +679,20 @@ def rossum_hook_request_handler(payload: dict) -> dict[str, Any]:
         match_count=match_count,
         memory_key=memory_key,
         similarity_threshold=similarity_threshold,
+        local_index=local_index,
     )
 
 
 def _get_embedding(text: str, huggingface_token: str) -> list[float] | None:
-    """Get embedding vector from HuggingFace API."""
+    """Get embedding vector from the cache, or from HuggingFace API on a miss."""
+    if (cached := _embedding_cache.get(EMBEDDING_MODEL, text)) is not None:
+        return cached
+
     try:
-        response = requests.post(
+        response = _request(
+            "POST",
             HUGGINGFACE_API_URL,
+            idempotent=True,
             headers={
                 "Authorization": f"Bearer {huggingface_token}",
                 "Content-Type": "application/json",
@@ -152,10 +701,12 @@ def _get_embedding(text: str, huggingface_token: str) -> list[float] | None:
             timeout=DEFAULT_TIMEOUT,
         )
         response.raise_for_status()
-        embedding = response.json()
+        embedding = _decode(response)
         # HuggingFace may return nested array [[0.1, 0.2, ...]] - unwrap if needed
         if embedding and isinstance(embedding, list) and isinstance(embedding[0], list):
             embedding = embedding[0]
+        if embedding:
+            _embedding_cache.put(EMBEDDING_MODEL, text, embedding)
         return embedding
     except requests.exceptions.RequestException:
         log.exception("HuggingFace embedding request failed")
@@ -170,34 +721,52 @@ def _retrieve(
     match_count: int,
     memory_key: str,
     similarity_threshold: float = 0,
+    local_index: _LocalIndex | None = None,
 ) -> dict[str, Any]:
-    """Search documents by semantic similarity using Supabase vector search."""
+    """
+    Search documents by semantic similarity using Supabase vector search.
+
+    A fresh local index is searched in process, otherwise the match function is called and a stale
+    or missing local index is resynced in the background for the next retrieve.
+    """
     try:
-        embedding = _get_embedding(memory_key, huggingface_token)
+        with _phase("embedding"):
+            embedding = _get_embedding(memory_key, huggingface_token)
         if embedding is None:
             return {"value": None, "struct": None, "found": False}
 
-        response = requests.post(
-            f"{supabase_url}/rest/v1/rpc/{match_function}",
-            headers={
-                "apikey": supabase_key,
-                "Authorization": f"Bearer {supabase_key}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "query_embedding": embedding,
-                "match_count": match_count,
-            },
-            timeout=DEFAULT_TIMEOUT,
-        )
+        if local_index is not None and local_index.is_fresh():
+            with _phase("search"):
+                results = local_index.search(embedding, match_count)
+        else:
+            if local_index is not None:
+                local_index.refresh_in_background(supabase_key)
+
+            response = _request(
+                "POST",
+                f"{supabase_url}/rest/v1/rpc/{match_function}",
+                idempotent=True,
+                headers={
+                    "apikey": supabase_key,
+                    "Authorization": f"Bearer {supabase_key}",
+                    "Content-Type": "application/json",
+                },
+                json={
+                    "query_embedding": embedding,
+                    "match_count": match_count,
+                },
+                timeout=DEFAULT_TIMEOUT,
+            )
 
-        if response.status_code == 404:
-            return {"value": None, "struct": None, "found": False}
+            if response.status_code == 404:
+                return {"value": None, "struct": None, "found": False}
+
+            response.raise_for_status()
+            results = _decode(response)
 
-        response.raise_for_status()
-        results = response.json()
         log.info(
-            f"Supabase RAG memory retrieve: key={memory_key}, count={len(results) if results else 0}, results={results}"
+            f"Supabase RAG memory retrieve: key={memory_key}, count={len(results) if results else 0}, results={results}",
+            extra={"embedding_cache": _embedding_cache.stats()},
         )
 
         if not results:
@@ -235,11 +804,13 @@ def _learn(
     memory_key: str,
     value: Any,
     struct: dict | None,
+    local_index: _LocalIndex | None = None,
 ) -> dict[str, Any]:
-    """Store document with embedding to Supabase."""
+    """Store document with embedding to Supabase, writing it through to the local index if enabled."""
     try:
         # Embed the key (index formula) for semantic matching
-        embedding = _get_embedding(memory_key, huggingface_token)
+        with _phase("embedding"):
+            embedding = _get_embedding(memory_key, huggingface_token)
         if embedding is None:
             return {}
 
@@ -250,14 +821,17 @@ def _learn(
             "learned_value": memory_key,
         }
 
-        response = requests.post(
+        response = _request(
+            "POST",
             f"{supabase_url}/rest/v1/{table_name}",
             headers={
                 "apikey": supabase_key,
                 "Authorization": f"Bearer {supabase_key}",
                 "Content-Type": "application/json",
-                "Prefer": "return=minimal",
+                # The local index needs the id of the new row to deduplicate it against later syncs
+                "Prefer": "return=representation" if local_index is not None else "return=minimal",
             },
+            params={"select": "id"} if local_index is not None else None,
             json=record,
             timeout=DEFAULT_TIMEOUT,
         )
@@ -273,6 +847,10 @@ def _learn(
                 },
             )
         response.raise_for_status()
+        if local_index is not None:
+            for row in _decode(response):
+                local_index.add(row["id"], value, memory_key, embedding)
+
         log.info(
             "Supabase RAG memory learn successful",
             extra={"table_name": table_name, "memory_key": memory_key},
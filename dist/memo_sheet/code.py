@@ -1,80 +1,472 @@
 # flake8: noqa
+import atexit
+import http.cookiejar
 import json
 import logging
-from typing import Any
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Callable, Iterator
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 
 log = logging.getLogger(__name__)
 
 DEFAULT_TIMEOUT = 30
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+MAX_RETRY_DELAY = 5
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+MAX_CONNECTIONS_PER_HOST = 10
+DEFAULT_SNAPSHOT_TTL = 60
+DEFAULT_LEARN_BATCH_SIZE = 20
+DEFAULT_LEARN_FLUSH_INTERVAL = 2
+LEARN_MAX_ATTEMPTS = 3
+
+
+# Module level, so that a warm worker keeps its keep-alive connections between invocations.
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+_host_slots: dict[str, threading.BoundedSemaphore] = {}
+
+
+def _get_session() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            # Share connections only: invocations of other organizations must never be sent cookies set for this one
+            _session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            adapter = HTTPAdapter(pool_maxsize=MAX_CONNECTIONS_PER_HOST)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def _get_host_slot(url: str) -> threading.BoundedSemaphore:
+    host = urlsplit(url).netloc
+    with _session_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+        return _host_slots[host]
+
+
+def _request(
+    method: str, url: str, max_retries: int = MAX_RETRIES, idempotent: bool | None = None, **kwargs: Any
+) -> requests.Response:
+    """
+    Send a request over the pooled session, retrying with backoff.
+
+    Idempotent requests (by method, or as declared by the caller) are retried on connection errors and
+    429/5xx responses. Other requests are retried only when they cannot have been processed, i.e. on a
+    connect timeout or a 429, so that e.g. an insert is never applied twice.
+    """
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+    retry_errors = requests.exceptions.ConnectionError if idempotent else requests.exceptions.ConnectTimeout
+    retry_status_codes = RETRY_STATUS_CODES if idempotent else (429,)
+    session = _get_session()
+    host_slot = _get_host_slot(url)
+
+    attempt = 0
+    while True:
+        try:
+            with host_slot, _phase("network"):
+                response = session.request(method, url, **kwargs)
+        except retry_errors:
+            if attempt >= max_retries:
+                raise
+            delay = RETRY_BACKOFF * 2**attempt
+        else:
+            if response.status_code not in retry_status_codes or attempt >= max_retries:
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            delay = float(retry_after) if retry_after.isdigit() else RETRY_BACKOFF * 2**attempt
+            response.close()
+
+        # Back off outside of the host slot, so that other callers to the host are not held up
+        time.sleep(min(delay, MAX_RETRY_DELAY))
+        attempt += 1
+
+
+# Per-phase timings of the current invocation in milliseconds, None unless the "timings" setting is on
+_timings: ContextVar[dict[str, float] | None] = ContextVar("timings", default=None)
+# Phases may be timed from worker threads of the same invocation, e.g. concurrent queries
+_timings_lock = threading.Lock()
+
+
+@contextmanager
+def _phase(name: str) -> Iterator[None]:
+    """Add the time spent in the block to the timings of the current invocation, if they are recorded."""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        with _timings_lock:
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def _instrumented(handler: Callable[[dict], Any]) -> Callable[[dict], Any]:
+    """
+    Record per-phase timings of an invocation when the "timings" setting is "response" or "log".
+
+    Phases are cumulative and may nest or overlap, e.g. concurrent network calls or a network call
+    made while computing an embedding. "total" is the wall time of the whole invocation.
+    """
+
+    @wraps(handler)
+    def wrapper(payload: dict) -> Any:
+        mode = (payload.get("settings") or {}).get("timings")
+        if mode not in ("response", "log"):
+            return handler(payload)
+
+        timings: dict[str, float] = {}
+        reset_token = _timings.set(timings)
+        try:
+            with _phase("total"):
+                result = handler(payload)
+        finally:
+            _timings.reset(reset_token)
+
+        timings = {name: round(milliseconds, 3) for name, milliseconds in timings.items()}
+        if mode == "response" and isinstance(result, dict):
+            result["timings"] = timings
+        else:
+            log.info("Hook timings", extra={"timings": timings})
+        return result
+
+    return wrapper
+
+
+def _decode(response: requests.Response) -> Any:
+    with _phase("decode"):
+        return response.json()
 
 
 # /** @OnlyCurrentDoc */
 
 # const SHEET_NAME = "Data";
+# const VERSION_PROPERTY = "version";
+
+# // Bumped on every write, so that snapshot clients can cheaply tell whether their copy is stale
+# function getVersion() {
+#   return Number(PropertiesService.getScriptProperties().getProperty(VERSION_PROPERTY) || 0);
+# }
+
+# function bumpVersion() {
+#   const version = getVersion() + 1;
+#   PropertiesService.getScriptProperties().setProperty(VERSION_PROPERTY, String(version));
+#   return version;
+# }
+
+# function jsonOutput(body) {
+#   return ContentService.createTextOutput(JSON.stringify(body)).setMimeType(ContentService.MimeType.JSON);
+# }
+
+# // Read Columns A:B only, instead of the whole data range
+# function readKeyValues(sheet) {
+#   const lastRow = sheet.getLastRow();
+#   return lastRow ? sheet.getRange(1, 1, lastRow, 2).getValues() : [];
+# }
 
 # // API for Searching (GET request)
+# // ?key=...          -> value of a single key
+# // ?action=version   -> current version only
+# // ?action=export    -> all [key, value] rows with the version they belong to
 # function doGet(e) {
-#   const searchKey = e.parameter.key;
+#   const action = e.parameter.action;
+
+#   if (action === "version") {
+#     return jsonOutput({ status: "success", version: getVersion() });
+#   }
+
 #   const sheet = SpreadsheetApp.getActiveSpreadsheet().getSheetByName(SHEET_NAME);
-#   const data = sheet.getDataRange().getValues();
-  
+
+#   if (action === "export") {
+#     const version = getVersion();
+#     const data = readKeyValues(sheet).map(row => [row[0].toString(), row[1]]);
+#     return jsonOutput({ status: "success", version: version, data: data });
+#   }
+
+#   const searchKey = e.parameter.key;
+#   const data = readKeyValues(sheet);
+
 #   // Search Column A, return Column B
 #   for (let i = 0; i < data.length; i++) {
 #     if (data[i][0].toString() === searchKey) {
-#       return ContentService.createTextOutput(JSON.stringify({ status: "success", value: data[i][1] }))
-#         .setMimeType(ContentService.MimeType.JSON);
+#       return jsonOutput({ status: "success", value: data[i][1] });
 #     }
 #   }
-  
-#   return ContentService.createTextOutput(JSON.stringify({ status: "error", message: "Key not found" }))
-#     .setMimeType(ContentService.MimeType.JSON);
+
+#   return jsonOutput({ status: "error", message: "Key not found" });
 # }
 
 # // API for Adding Rows (POST request)
+# // { key, value }                 -> upsert a single key
+# // { entries: [{ key, value }] }  -> upsert many keys with one read, one write to Column B and one append
 # function doPost(e) {
+#   const lock = LockService.getScriptLock();
 #   try {
+#     lock.waitLock(30000);
+
 #     const params = JSON.parse(e.postData.contents);
 #     const sheet = SpreadsheetApp.getActiveSpreadsheet().getSheetByName(SHEET_NAME);
-    
-#     const keyStr = params.key.toString().trim();
-#     const valueStr = params.value.toString();
-    
-#     // 1. Get all existing data to search for the key
-#     const data = sheet.getDataRange().getValues();
-#     let rowIndex = -1;
+#     const entries = params.entries || [{ key: params.key, value: params.value }];
+#     const previousVersion = getVersion();
 
-#     // 2. Look for the key in Column A
+#     // 1. Index Column A once, instead of scanning it for every key
+#     const data = readKeyValues(sheet);
+#     const rowIndexByKey = {};
 #     for (let i = 0; i < data.length; i++) {
-#       if (data[i][0].toString().trim() === keyStr) {
-#         rowIndex = i + 1; // Rows are 1-indexed in Google Sheets
-#         break;
+#       rowIndexByKey[data[i][0].toString().trim()] = i + 1; // Rows are 1-indexed in Google Sheets
+#     }
+
+#     const inserted = {};
+#     let updated = 0;
+#     let firstUpdatedRow = Infinity;
+#     let lastUpdatedRow = 0;
+
+#     for (const entry of entries) {
+#       const keyStr = entry.key.toString().trim();
+#       const valueStr = entry.value.toString();
+#       const row = rowIndexByKey[keyStr];
+
+#       if (row !== undefined) {
+#         // 2. KEY FOUND: Update the existing row (Column B) in the data already read
+#         data[row - 1][1] = valueStr;
+#         firstUpdatedRow = Math.min(firstUpdatedRow, row);
+#         lastUpdatedRow = Math.max(lastUpdatedRow, row);
+#         updated++;
+#       } else {
+#         // 3. KEY NOT FOUND: Collect it for a single append, last write wins
+#         inserted[keyStr] = valueStr;
 #       }
 #     }
 
-#     if (rowIndex !== -1) {
-#       // 3. KEY FOUND: Update the existing row (Column B)
-#       sheet.getRange(rowIndex, 2).setValue(valueStr);
-#       return ContentService.createTextOutput(JSON.stringify({ status: "success", action: "updated" }))
-#         .setMimeType(ContentService.MimeType.JSON);
-#     } else {
-#       // 4. KEY NOT FOUND: Insert a new row
-#       const lastRow = sheet.getLastRow() + 1;
-#       const range = sheet.getRange(lastRow, 1, 1, 2);
-      
+#     // Write back only the span of Column B that holds updated rows, in a single call
+#     if (updated) {
+#       const values = data.slice(firstUpdatedRow - 1, lastUpdatedRow).map(row => [row[1]]);
+#       sheet.getRange(firstUpdatedRow, 2, values.length, 1).setValues(values);
+#     }
+
+#     const rows = Object.keys(inserted).map(keyStr => [keyStr, inserted[keyStr]]);
+#     if (rows.length) {
+#       const range = sheet.getRange(sheet.getLastRow() + 1, 1, rows.length, 2);
 #       range.setNumberFormat('@'); // Ensure plain text for leading zeros
-#       range.setValues([[keyStr, valueStr]]);
-      
-#       return ContentService.createTextOutput(JSON.stringify({ status: "success", action: "inserted" }))
-#         .setMimeType(ContentService.MimeType.JSON);
+#       range.setValues(rows);
 #     }
+
+#     const version = bumpVersion();
+#     const action = entries.length === 1 ? (rows.length ? "inserted" : "updated") : "upserted";
+
+#     return jsonOutput({
+#       status: "success",
+#       action: action,
+#       updated: updated,
+#       inserted: rows.length,
+#       previous_version: previousVersion,
+#       version: version,
+#     });
 #   } catch (err) {
-#     return ContentService.createTextOutput(JSON.stringify({ status: "error", message: err.message }))
-#       .setMimeType(ContentService.MimeType.JSON);
+#     return jsonOutput({ status: "error", message: err.message });
+#   } finally {
+#     lock.releaseLock();
 #   }
 # }
 
+
+class _SheetSnapshot:
+    """
+    Hashed in-memory copy of the key/value sheet behind one web app URL.
+
+    The sheet is exported in one request and re-exported only when the script's version has moved on,
+    checked at most once per ttl. Learned values are applied locally right away and upserted back to the
+    sheet in batches of batch_size keys, or flush_interval seconds after the first pending one. Entries of
+    an upsert that failed transiently are queued again for the next flush, and dropped after
+    LEARN_MAX_ATTEMPTS failed upserts.
+    """
+
+    def __init__(self, webapp_url: str) -> None:
+        self.webapp_url = webapp_url
+        self.ttl = DEFAULT_SNAPSHOT_TTL
+        self.batch_size = DEFAULT_LEARN_BATCH_SIZE
+        self.flush_interval = DEFAULT_LEARN_FLUSH_INTERVAL
+        self.version: int | None = None
+        self.checked_at = 0.0
+        self._values: dict[str, Any] = {}
+        self._pending: dict[str, str] = {}
+        self._in_flight: dict[str, str] = {}
+        # Failed upserts of the pending value of a key
+        self._attempts: dict[str, int] = {}
+        self._timer: threading.Timer | None = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def get(self, memory_key: str) -> dict[str, Any]:
+        self._refresh()
+        with self._lock:
+            if memory_key in self._values:
+                return {"value": self._values[memory_key], "found": True}
+        return {"value": None, "found": False}
+
+    def set(self, memory_key: str, value: str) -> None:
+        with self._lock:
+            self._values[memory_key] = value
+            self._pending.pop(memory_key, None)
+            self._pending[memory_key] = value
+            self._attempts.pop(memory_key, None)
+
+            is_full = len(self._pending) >= self.batch_size
+            if not is_full:
+                self._schedule()
+
+        if is_full:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            entries, self._pending = self._pending, {}
+            self._in_flight.update(entries)
+
+        items = list(entries.items())
+        chunk_size = max(self.batch_size, 1)
+        for start in range(0, len(items), chunk_size):
+            self._upsert(dict(items[start : start + chunk_size]))
+
+    def _upsert(self, entries: dict[str, str]) -> None:
+        with self._lock:
+            expected_version = self.version
+
+        retry = False
+        try:
+            response = _request(
+                "POST",
+                self.webapp_url,
+                idempotent=True,
+                json={"entries": [{"key": key, "value": value} for key, value in entries.items()]},
+                allow_redirects=True,
+            )
+            response.raise_for_status()
+            data = _decode(response)
+            if data.get("status") != "success":
+                raise ValueError(data.get("message"))
+
+            # Only our own write happened since the snapshot was taken, so it is still complete
+            if expected_version is not None and data.get("previous_version") == expected_version:
+                with self._lock:
+                    if self.version == expected_version:
+                        self.version = data.get("version")
+        except Exception as e:
+            # Errors reported by the script or client errors would fail again, everything else is worth another try
+            if isinstance(e, requests.exceptions.RequestException):
+                status_code = e.response.status_code if e.response is not None else None
+                retry = status_code is None or status_code == 429 or status_code >= 500
+            log.exception("Sheets memory batched learn failed", extra={"keys": list(entries), "retry": retry})
+        finally:
+            dropped = []
+            with self._lock:
+                for memory_key, value in entries.items():
+                    if self._in_flight.get(memory_key) is not value:
+                        continue
+                    del self._in_flight[memory_key]
+                    if not retry:
+                        self._attempts.pop(memory_key, None)
+                        continue
+                    # A newer pending value of the same key supersedes the failed one
+                    if memory_key in self._pending:
+                        continue
+                    attempts = self._attempts.pop(memory_key, 0) + 1
+                    if attempts < LEARN_MAX_ATTEMPTS:
+                        self._pending[memory_key] = value
+                        self._attempts[memory_key] = attempts
+                    else:
+                        dropped.append(memory_key)
+                if retry and self._pending:
+                    self._schedule()
+
+            if dropped:
+                log.error(
+                    "Sheets memory batched learn gave up", extra={"keys": dropped, "attempts": LEARN_MAX_ATTEMPTS}
+                )
+
+    def _schedule(self) -> None:
+        """Arm the flush timer unless it is already running. Callers must hold the lock."""
+        if self._timer is None:
+            self._timer = threading.Timer(self.flush_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _refresh(self) -> None:
+        if self.version is not None and time.monotonic() - self.checked_at < self.ttl:
+            return
+
+        with self._refresh_lock:
+            if self.version is not None and time.monotonic() - self.checked_at < self.ttl:
+                return
+
+            if self.version is not None:
+                response = _request("GET", self.webapp_url, params={"action": "version"}, allow_redirects=True)
+                response.raise_for_status()
+                if _decode(response).get("version") == self.version:
+                    self.checked_at = time.monotonic()
+                    return
+
+            response = _request("GET", self.webapp_url, params={"action": "export"}, allow_redirects=True)
+            response.raise_for_status()
+            data = _decode(response)
+            if data.get("status") != "success":
+                raise ValueError(data.get("message"))
+
+            values = {str(row[0]): row[1] for row in data.get("data", [])}
+            with self._lock:
+                # Learned values that have not reached the sheet yet must survive the reload
+                values.update(self._in_flight)
+                values.update(self._pending)
+                self._values = values
+                self.version = data.get("version")
+                self.checked_at = time.monotonic()
+
+
+_snapshots: dict[str, _SheetSnapshot] = {}
+_snapshots_lock = threading.Lock()
+
+
+def _get_snapshot(webapp_url: str, settings: dict) -> _SheetSnapshot:
+    with _snapshots_lock:
+        if webapp_url not in _snapshots:
+            _snapshots[webapp_url] = _SheetSnapshot(webapp_url)
+        snapshot = _snapshots[webapp_url]
+
+    snapshot.ttl = float(settings.get("snapshot_ttl", DEFAULT_SNAPSHOT_TTL))
+    snapshot.batch_size = int(settings.get("learn_batch_size", DEFAULT_LEARN_BATCH_SIZE))
+    snapshot.flush_interval = float(settings.get("learn_flush_interval", DEFAULT_LEARN_FLUSH_INTERVAL))
+    return snapshot
+
+
+@atexit.register
+def _flush_snapshots() -> None:
+    with _snapshots_lock:
+        snapshots = list(_snapshots.values())
+    for snapshot in snapshots:
+        snapshot.flush()
+
+
+@_instrumented
 def rossum_hook_request_handler(payload: dict) -> dict[str, Any]:
     """
     Google Sheets Key/Value memory provider.
@@ -83,6 +475,13 @@ def rossum_hook_request_handler(payload: dict) -> dict[str, Any]:
     - configure: Returns configuration form for the Google Web App URL
     - learn: Appends a row [key, value] to the Google Sheet
     - retrieve: Searches for 'key' in Column A and returns Column B
+
+    Settings:
+    - google_webapp_url: URL of the deployed Apps Script above
+    - snapshot: Answer retrieves from an in-memory copy of the sheet and batch learns back to it
+    - snapshot_ttl: Seconds between version checks of the snapshot, defaults to 60
+    - learn_batch_size: Keys per batched upsert in snapshot mode, defaults to 20
+    - learn_flush_interval: Seconds before a partial batch is upserted anyway, defaults to 2
     """
     variant = payload.get("variant", "retrieve")
     inner_payload = payload.get("payload", {})
@@ -107,13 +506,26 @@ def rossum_hook_request_handler(payload: dict) -> dict[str, Any]:
         log.warning("Sheets Memory: key not specified")
         return {"value": None, "found": False}
 
+    snapshot = _get_snapshot(webapp_url, settings) if settings.get("snapshot") else None
+
     if mode == "learn":
+        if snapshot is not None:
+            snapshot.set(str(memory_key).strip(), str(inner_payload.get("value")))
+            return {}
+
         return _learn(
             webapp_url=webapp_url,
             memory_key=memory_key,
             value=inner_payload.get("value")
         )
 
+    if snapshot is not None:
+        try:
+            with _phase("snapshot"):
+                return snapshot.get(str(memory_key))
+        except Exception:
+            log.exception("Sheets memory snapshot refresh failed, retrieving the key directly")
+
     return _retrieve(
         webapp_url=webapp_url,
         memory_key=memory_key
@@ -124,14 +536,15 @@ def _retrieve(webapp_url: str, memory_key: str) -> dict[str, Any]:
     """Lookup search: Column A -> Column B."""
     try:
         # Google Apps Script doGet(e) handles parameters in the query string
-        response = requests.get(
+        response = _request(
+            "GET",
             webapp_url,
             params={"key": memory_key},
             timeout=DEFAULT_TIMEOUT,
             allow_redirects=True  # Important: Google Apps Script redirects to a temp URL
         )
         response.raise_for_status()
-        data = response.json()
+        data = _decode(response)
 
         if data.get("status") == "success":
             return {
@@ -150,8 +563,10 @@ def _learn(webapp_url: str, memory_key: str, value: Any) -> dict[str, Any]:
     """Add a row: [key, value]."""
     try:
         # Google Apps Script doPost(e) handles JSON body
-        response = requests.post(
+        response = _request(
+            "POST",
             webapp_url,
+            idempotent=True,
             json={"key": memory_key, "value": str(value)},
             timeout=DEFAULT_TIMEOUT,
             allow_redirects=True
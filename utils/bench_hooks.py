@@ -0,0 +1,448 @@
+#! /usr/bin/env python3
+"""
+Offline benchmark of the Python extensions in dist/*/code.py.
+
+Every rossum_hook_request_handler is run against a local stand-in server that emulates the Rossum
+annotation search, Master Data Hub aggregate/PATCH/metadata, Supabase REST/RPC, HuggingFace
+feature-extraction and the Google Sheets web app, each answering after a configurable latency.
+For every handler variant and mode the p50/p99 latency and the throughput are reported, together
+with the mean per-phase timings the handlers record when the "timings" setting is on. Phase means are
+taken over all measured invocations, a phase that only some invocations went through is followed by the
+share of invocations that did, e.g. "network 0.6 (5%)".
+
+Usage:
+    python utils/bench_hooks.py --latency-ms 20 --rows 5000 --iterations 200 --concurrency 4
+    python utils/bench_hooks.py --only lookup_mdh memo_rag
+
+Requires the packages the extensions import at runtime (requests, and numpy for the local index).
+"""
+
+import argparse
+import hashlib
+import importlib.util
+import json
+import math
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+DIST_DIR = Path(__file__).resolve().parent.parent / "dist"
+MDH_PREFIX = "/svc/master-data-hub/api"
+EMBEDDING_DIMENSIONS = 384
+
+
+def _embed(text: str) -> list[float]:
+    """Deterministic stand-in for all-MiniLM-L6-v2, so that equal texts get equal vectors."""
+    seed = hashlib.sha256(text.encode("utf-8")).digest()
+    return [((seed[i % len(seed)] * (i + 1)) % 255) / 255 - 0.5 for i in range(EMBEDDING_DIMENSIONS)]
+
+
+class StandInState:
+    """Datasets served by the stand-in server."""
+
+    def __init__(self, rows: int, latency: float) -> None:
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.version = 0
+        self.mdh: dict[str, list[dict]] = {
+            "vendors": [{"vendor_id": str(i), "name": f"Vendor {i}", "vat": f"CZ{i:08d}"} for i in range(rows)],
+            "memory": [{"memory_key": f"key {i}", "value": f"value {i}"} for i in range(rows)],
+        }
+        self.annotations = [{"id": i, "document": f"/documents/{i}", "status": "to_review"} for i in range(rows)]
+        self.documents = [{"url": f"/documents/{i}", "original_file_name": f"invoice_{i}.pdf"} for i in range(rows)]
+        self.supabase = [
+            {
+                "id": i + 1,
+                "content": f"value {i}",
+                "learned_value": f"key {i}",
+                "embedding": json.dumps(_embed(f"key {i}")),
+            }
+            for i in range(rows)
+        ]
+        self.sheet = {f"key {i}": f"value {i}" for i in range(rows)}
+
+
+def _match(record: dict, condition: dict) -> bool:
+    """The small subset of MongoDB $match the extensions send."""
+    for key, value in condition.items():
+        if key == "$and":
+            if not all(_match(record, part) for part in value):
+                return False
+        elif isinstance(value, dict):
+            for operator, operand in value.items():
+                if operator == "$eq" and record.get(key) != operand:
+                    return False
+                if operator == "$in" and record.get(key) not in operand:
+                    return False
+                if operator == "$regex" and not re.search(operand, str(record.get(key, ""))):
+                    return False
+        elif record.get(key) != value:
+            return False
+    return True
+
+
+def _aggregate(records: list[dict], pipeline: list[dict]) -> list[dict]:
+    for stage in pipeline:
+        if "$match" in stage:
+            records = [record for record in records if _match(record, stage["$match"])]
+        elif "$limit" in stage:
+            records = records[: stage["$limit"]]
+        elif "$project" in stage:
+            records = [
+                {
+                    name: (
+                        record.get(source[1:])
+                        if isinstance(source, str) and source.startswith("$")
+                        else record.get(name)
+                    )
+                    for name, source in stage["$project"].items()
+                }
+                for record in records
+            ]
+    return records
+
+
+def make_handler(state: StandInState) -> type[BaseHTTPRequestHandler]:
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+        def _body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def _send(self, body: Any, status: int = 200) -> None:
+            content = json.dumps(body).encode("utf-8")
+            time.sleep(state.latency)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self) -> None:
+            url = urlsplit(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+            if url.path == "/api/v1/organizations":
+                return self._send({"results": [{"metadata": {"mdh_master_token": "token"}}]})
+            if url.path == f"{MDH_PREFIX}/v2/datasets/metadata":
+                return self._send([{"name": name, "metadata": {"description": name}} for name in state.mdh])
+            if url.path.startswith("/rest/v1/"):
+                after = int(query.get("id", "gt.0")[3:])
+                rows = [row for row in state.supabase if row["id"] > after]
+                return self._send(rows[: int(query.get("limit", len(rows)))])
+            if url.path == "/sheet":
+                if query.get("action") == "version":
+                    return self._send({"status": "success", "version": state.version})
+                if query.get("action") == "export":
+                    data = [[key, value] for key, value in state.sheet.items()]
+                    return self._send({"status": "success", "version": state.version, "data": data})
+                if query.get("key") in state.sheet:
+                    return self._send({"status": "success", "value": state.sheet[query["key"]]})
+                return self._send({"status": "error", "message": "Key not found"})
+            self._send({"message": "Not found"}, 404)
+
+        def do_POST(self) -> None:
+            url = urlsplit(self.path)
+            body = json.loads(self._body() or b"null")
+
+            if url.path == "/api/v1/annotations/search":
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                page_size = int(query.get("page_size", 20))
+                start = int(query.get("search_after", 0))
+                results = state.annotations[start : start + page_size]
+                urls = {result["document"] for result in results}
+                next_url = None
+                if start + page_size < len(state.annotations):
+                    next_query = urlencode({**query, "search_after": start + page_size})
+                    next_url = f"http://{self.headers['Host']}{url.path}?{next_query}"
+                return self._send(
+                    {
+                        "pagination": {"next": next_url, "total": len(state.annotations)},
+                        "results": results,
+                        "documents": [document for document in state.documents if document["url"] in urls],
+                    }
+                )
+            if url.path == f"{MDH_PREFIX}/v1/data/aggregate":
+                records = state.mdh.get(body["dataset"], [])
+                return self._send({"results": _aggregate(records, body["aggregate"])})
+            if url.path == "/hf":
+                return self._send([_embed(body["inputs"])])
+            if url.path.startswith("/rest/v1/rpc/"):
+                return self._send(
+                    [
+                        {"content": row["content"], "learned_value": row["learned_value"], "similarity": 0.9}
+                        for row in state.supabase[: body.get("match_count", 3)]
+                    ]
+                )
+            if url.path.startswith("/rest/v1/"):
+                with state.lock:
+                    row = {**body, "id": len(state.supabase) + 1, "embedding": json.dumps(body["embedding"])}
+                    state.supabase.append(row)
+                return self._send([{"id": row["id"]}], 201)
+            if url.path == "/sheet":
+                with state.lock:
+                    previous_version = state.version
+                    for entry in body.get("entries") or [body]:
+                        state.sheet[str(entry["key"]).strip()] = str(entry["value"])
+                    state.version += 1
+                    return self._send(
+                        {"status": "success", "previous_version": previous_version, "version": state.version}
+                    )
+            self._send({"message": "Not found"}, 404)
+
+        def do_PATCH(self) -> None:
+            url = urlsplit(self.path)
+            if not url.path.startswith(f"{MDH_PREFIX}/v1/dataset/"):
+                return self._send({"message": "Not found"}, 404)
+
+            dataset = url.path.rsplit("/", 1)[-1]
+            message = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8") + self._body()
+            )
+            for part in message.iter_parts():
+                if part.get_param("name", header="content-disposition") == "file":
+                    records = json.loads(part.get_payload(decode=True))
+                    with state.lock:
+                        existing = {record["memory_key"]: record for record in state.mdh.setdefault(dataset, [])}
+                        existing.update({record["memory_key"]: record for record in records})
+                        state.mdh[dataset] = list(existing.values())
+            self._send({})
+
+    return StandInHandler
+
+
+def load_extension(name: str) -> Any:
+    spec = importlib.util.spec_from_file_location(f"bench_{name}", DIST_DIR / name / "code.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def scenarios(base_url: str, rows: int) -> dict[str, dict[str, Callable[[int], dict]]]:
+    """Payload factories per extension and "variant/mode", called with the iteration number."""
+    rossum = {"base_url": base_url, "rossum_authorization_token": "token"}
+    supabase = {"supabase_url": base_url}
+    secrets = {"supabase_key": "key", "huggingface_token": "token"}
+    sheet = {"google_webapp_url": f"{base_url}/sheet"}
+
+    def key(i: int) -> str:
+        return f"key {i % rows}"
+
+    fallback_queries = [
+        {"filters": [{"match_key": "vat", "value": "missing"}]},
+        {"filters": [{"match_key": "name", "value": "missing"}]},
+        {"filters": [{"match_key": "vendor_id", "value": "1"}]},
+    ]
+    aggregate_queries = json.dumps(
+        [
+            {"//": "miss", "aggregate": [{"$match": {"vat": "$$vat"}}, {"$limit": 5}]},
+            {
+                "//": "hit",
+                "aggregate": [
+                    {"$match": {"vendor_id": "$$vendor_id"}},
+                    {"$project": {"value": "$vendor_id", "label": "$name"}},
+                    {"$limit": 5},
+                ],
+            },
+        ]
+    )
+
+    def lookup(settings: dict) -> Callable[[int], dict]:
+        return lambda i: {
+            **rossum,
+            "variant": "queue_lookup",
+            "configure": False,
+            "settings": settings,
+            "payload": {
+                "dataset": "vendors",
+                "value_key": "vendor_id",
+                "label_key": "name",
+                "queries": [dict(query) for query in fallback_queries],
+            },
+        }
+
+    def lookup_aggregate(i: int) -> dict:
+        return {
+            **rossum,
+            "variant": "queue_lookup_aggregate",
+            "configure": False,
+            "settings": {},
+            "payload": {
+                "dataset": "vendors",
+                "queries": aggregate_queries,
+                "placeholders": {"vat": "missing", "vendor_id": {"__formula": str(i % rows)}},
+            },
+        }
+
+    def annotations(payload: dict) -> Callable[[int], dict]:
+        return lambda i: {
+            **rossum,
+            "configure": False,
+            "settings": {},
+            "payload": {"value_key": "id", "label_key": "document__original_file_name", **payload},
+        }
+
+    def memo_mdh(mode: str, settings: dict | None = None, bulk: bool = False) -> Callable[[int], dict]:
+        def payload(i: int) -> dict:
+            inner: dict[str, Any] = {"mode": mode, "dataset": "memory"}
+            if bulk:
+                inner["keys"] = [key(i + offset) for offset in range(20)]
+            else:
+                inner.update({"key": key(i), "value": f"learned {i}"})
+            return {**rossum, "variant": mode, "settings": settings or {}, "payload": inner}
+
+        return payload
+
+    def memo_rag(mode: str, settings: dict | None = None) -> Callable[[int], dict]:
+        return lambda i: {
+            **rossum,
+            "variant": mode,
+            "settings": {**supabase, **(settings or {})},
+            "secrets": secrets,
+            "payload": {"mode": mode, "key": key(i % 50), "value": f"learned {i}"},
+        }
+
+    def memo_sheet(mode: str, settings: dict | None = None) -> Callable[[int], dict]:
+        return lambda i: {
+            "variant": mode,
+            "settings": {**sheet, **(settings or {})},
+            "payload": {"mode": mode, "key": key(i), "value": f"learned {i}"},
+        }
+
+    return {
+        "lookup_mdh": {
+            "queue_lookup/sequential": lookup({}),
+            "queue_lookup/speculative": lookup({"max_concurrent_queries": 3}),
+            "queue_lookup_aggregate/sequential": lookup_aggregate,
+        },
+        "lookup_annotations": {
+            "queue_lookup/first-100": annotations({"max_options": 100}),
+            "queue_lookup/all-pages": annotations({}),
+            "queue_lookup/all-pages-prefetch": annotations({"prefetch": True}),
+        },
+        "memo_mdh": {
+            "retrieve/single": memo_mdh("retrieve"),
+            "retrieve/bulk-20": memo_mdh("retrieve", bulk=True),
+            "learn/immediate": memo_mdh("learn"),
+            "learn/batched": memo_mdh("learn", {"learn_batch_size": 20}),
+        },
+        "memo_rag": {
+            "retrieve/rpc": memo_rag("retrieve"),
+            "retrieve/local-index": memo_rag("retrieve", {"local_index": True}),
+            "learn/default": memo_rag("learn"),
+        },
+        "memo_sheet": {
+            "retrieve/per-key": memo_sheet("retrieve"),
+            "retrieve/snapshot": memo_sheet("retrieve", {"snapshot": True}),
+            "learn/per-key": memo_sheet("learn"),
+            "learn/snapshot": memo_sheet("learn", {"snapshot": True}),
+        },
+    }
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def share(count: int, total: int) -> str:
+    return "" if count >= total else f" ({100 * count / total:.0f}%)"
+
+
+def run_scenario(handler: Callable[[dict], Any], make_payload: Callable[[int], dict], args: argparse.Namespace) -> dict:
+    # Warm up connection pools and caches, the way a long-lived worker would be
+    for i in range(args.warmup):
+        handler(make_payload(i))
+
+    latencies: list[float] = []
+    phases: dict[str, list[float]] = defaultdict(list)
+
+    def invoke(i: int) -> None:
+        payload = make_payload(i)
+        payload["settings"] = {**payload.get("settings", {}), "timings": "response"}
+        start = time.perf_counter()
+        result = handler(payload)
+        latencies.append((time.perf_counter() - start) * 1000)
+        for phase, milliseconds in (result.get("timings") or {}).items():
+            phases[phase].append(milliseconds)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(invoke, range(args.iterations)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "throughput": len(latencies) / elapsed,
+        # Invocations that skipped a phase count as zero, so that means of different phases add up
+        "phases": {phase: sum(values) / len(latencies) for phase, values in sorted(phases.items())},
+        "phase_invocations": {phase: len(values) for phase, values in sorted(phases.items())},
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency-ms", type=float, default=20, help="latency of every stand-in response")
+    parser.add_argument("--rows", type=int, default=1000, help="rows in every stand-in dataset")
+    parser.add_argument("--iterations", type=int, default=100, help="measured invocations per scenario")
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured invocations per scenario")
+    parser.add_argument("--concurrency", type=int, default=1, help="invocations in flight at once")
+    parser.add_argument("--only", nargs="*", help="extensions to benchmark, e.g. lookup_mdh memo_rag")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    state = StandInState(rows=args.rows, latency=args.latency_ms / 1000)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    results: dict[str, dict[str, dict]] = {}
+    for name, variants in scenarios(base_url, args.rows).items():
+        if args.only and name not in args.only:
+            continue
+
+        module = load_extension(name)
+        if hasattr(module, "HUGGINGFACE_API_URL"):
+            module.HUGGINGFACE_API_URL = f"{base_url}/hf"
+
+        results[name] = {}
+        for variant, make_payload in variants.items():
+            results[name][variant] = run_scenario(module.rossum_hook_request_handler, make_payload, args)
+            if not args.json:
+                result = results[name][variant]
+                phases = ", ".join(
+                    f"{phase} {ms:.1f}" + share(result["phase_invocations"][phase], args.iterations)
+                    for phase, ms in result["phases"].items()
+                    if phase != "total"
+                )
+                print(
+                    f"{name:<20} {variant:<36} p50 {result['p50']:8.1f} ms  p99 {result['p99']:8.1f} ms  "
+                    f"{result['throughput']:8.1f} req/s  [{phases}]"
+                )
+
+        # Upload what batched learns still hold while the stand-in server is up
+        for flush in ("_flush_learn_buffers", "_flush_snapshots"):
+            if hasattr(module, flush):
+                getattr(module, flush)()
+
+    server.shutdown()
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()